@@ -1,40 +1,357 @@
+import argparse
+import asyncio
+import collections
+import email.utils
+import gzip
+import html
+import io
+import mimetypes
+import multiprocessing
 import os
+import queue
+import select
+import selectors
+import signal
+import socket
+import stat as stat_module
 import subprocess
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+import zlib
 import http.server
 
 class ServerException(Exception):
 	'''For internal error reporting.'''
 	pass
 
+class CgiTimeout(ServerException):
+	'''A CGI script ran past its time limit.'''
+	pass
+
+
+class FileCache(object):
+	'''
+	LRU of small files' contents, bounded by total bytes. An entry is only
+	used while the file's mtime and size still match the ones it was read
+	with, so edits on disk are picked up by the next request.
+	'''
+
+	def __init__(self, max_bytes=16 * 1024 * 1024, max_file_size=256 * 1024):
+		self.max_bytes = max_bytes
+		self.max_file_size = max_file_size
+		self.size = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, path, stat):
+		with self._lock:
+			entry = self._entries.get(path)
+			if entry is None:
+				return None
+			if entry[0] != (stat.st_mtime_ns, stat.st_size):
+				self._remove(path)
+				return None
+			self._entries.move_to_end(path)
+			return entry[1]
+
+	def put(self, path, stat, content):
+		if self.max_file_size is not None and len(content) > self.max_file_size:
+			return
+		with self._lock:
+			if path in self._entries:
+				self._remove(path)
+			self._entries[path] = ((stat.st_mtime_ns, stat.st_size), content)
+			self.size += len(content)
+			# The entry just added stays even if it alone is over max_bytes.
+			while self.size > self.max_bytes and len(self._entries) > 1:
+				self._remove(next(iter(self._entries)))
+
+	def _remove(self, path):
+		self.size -= len(self._entries.pop(path)[1])
+
+def run_script(scripts, path):
+	'''
+	Run the Python script at path in this process as if it were __main__,
+	returning (stdout bytes, traceback text or None). Compiled code is kept
+	in scripts by path and reused until the file's mtime changes.
+	'''
+	capture = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+	stdout, argv = sys.stdout, sys.argv
+	sys.stdout, sys.argv = capture, [path]
+	error = None
+	try:
+		mtime = os.stat(path).st_mtime_ns
+		if path not in scripts or scripts[path][0] != mtime:
+			with open(path, 'rb') as reader:
+				scripts[path] = (mtime, compile(reader.read(), path, 'exec'))
+		exec(scripts[path][1], {'__name__': '__main__', '__file__': path})
+	except SystemExit:
+		pass
+	except BaseException:
+		error = traceback.format_exc()
+	finally:
+		capture.flush()
+		sys.stdout, sys.argv = stdout, argv
+	return capture.buffer.getvalue(), error
+
+def cgi_worker(connection):
+	'''Main loop of a CgiPool process: script paths in, results out.'''
+	# A Ctrl-C or SIGTERM for the whole process group must not kill a
+	# script the server is still draining; the server stops its workers.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	scripts = {}
+	while True:
+		try:
+			path = connection.recv()
+		except EOFError: # the server went away
+			return
+		connection.send(run_script(scripts, path))
+
+class CgiPool(object):
+	'''
+	Long-lived worker processes that run CGI scripts in-process, so each
+	request skips interpreter startup and the script's imports. A worker
+	that runs past timeout is killed and replaced. run() blocks while every
+	worker is busy.
+	'''
+
+	def __init__(self, size, timeout=None):
+		self.timeout = timeout
+		# spawn, not fork: the server is multi-threaded by the time workers
+		# start, and they only need this module's cgi_worker.
+		self._context = multiprocessing.get_context('spawn')
+		self._idle = queue.LifoQueue() # the most recently used worker is warmest
+		for _ in range(size):
+			self._idle.put(None) # started on first use
+
+	def run(self, path):
+		worker = self._idle.get()
+		try:
+			if worker is None:
+				worker = self._start()
+			process, connection = worker
+			connection.send(path)
+			if not connection.poll(self.timeout):
+				self._stop(worker)
+				worker = None
+				raise CgiTimeout("'{0}' took longer than {1}s".format(path, self.timeout))
+			output, error = connection.recv()
+		except (EOFError, OSError) as msg:
+			if worker is not None:
+				self._stop(worker)
+				worker = None
+			raise ServerException("CGI worker failed: {0}".format(msg))
+		finally:
+			self._idle.put(worker)
+		if error is not None:
+			sys.stderr.write(error) # as a script's own stderr would be
+		return output
+
+	def _start(self):
+		connection, child = self._context.Pipe()
+		process = self._context.Process(target=cgi_worker, args=(child,), daemon=True)
+		process.start()
+		child.close()
+		return process, connection
+
+	def _stop(self, worker):
+		process, connection = worker
+		process.kill()
+		process.join()
+		connection.close()
+
+	def close(self):
+		while True:
+			try:
+				worker = self._idle.get_nowait()
+			except queue.Empty:
+				return
+			if worker is not None:
+				self._stop(worker)
+
+def stat_or_none(path):
+	try:
+		return os.stat(path)
+	except (OSError, ValueError): # missing, unreadable, or an embedded NUL
+		return None
+
+class Resolved(object):
+	'''
+	What a request path refers to on disk, from a single stat that every
+	case's test shares. A directory's index file is stat'ed at most once,
+	and only if some case asks about it.
+	'''
+
+	def __init__(self, absolute_path):
+		self.stat = stat_or_none(absolute_path)
+		self._index_stat = None
+		self._index_checked = False
+
+	@property
+	def exists(self):
+		return self.stat is not None
+
+	@property
+	def is_file(self):
+		return self.stat is not None and stat_module.S_ISREG(self.stat.st_mode)
+
+	@property
+	def is_dir(self):
+		return self.stat is not None and stat_module.S_ISDIR(self.stat.st_mode)
+
+	def index_stat(self, index_path):
+		if not self._index_checked:
+			self._index_stat = stat_or_none(index_path)
+			self._index_checked = True
+		return self._index_stat
+
+	def index_is_file(self, index_path):
+		index_stat = self.index_stat(index_path)
+		return index_stat is not None and stat_module.S_ISREG(index_stat.st_mode)
+
+class RouteCache(object):
+	'''
+	Remembers, for ttl seconds, which case a request path resolved to and
+	the stats it was resolved with, so a hot URL skips the stats entirely.
+	Changes on disk show up once the entry expires.
+	'''
+
+	def __init__(self, ttl, max_size=4096):
+		self.ttl = ttl
+		self.max_size = max_size
+		self._routes = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, path):
+		with self._lock:
+			route = self._routes.get(path)
+			if route is None:
+				return None
+			if route[0] < time.monotonic():
+				del self._routes[path]
+				return None
+			return route[1], route[2]
+
+	def put(self, path, case, resolved):
+		with self._lock:
+			self._routes[path] = (time.monotonic() + self.ttl, case, resolved)
+			self._routes.move_to_end(path)
+			if len(self._routes) > self.max_size:
+				self._routes.popitem(last=False)
+
+def validators(stat, encoding=None):
+	'''
+	ETag and Last-Modified values for a file with this stat, as sent with
+	the given Content-Encoding.
+	'''
+	tag = '{0:x}-{1:x}'.format(stat.st_mtime_ns, stat.st_size)
+	if encoding is not None:
+		tag += '-' + encoding
+	return '"{0}"'.format(tag), email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+# Types worth compressing besides text/*.
+COMPRESSIBLE_TYPES = set(['application/javascript', 'application/json',
+						  'application/xml', 'image/svg+xml'])
+
+# What to call a file that mimetypes says is itself compressed, e.g.
+# archive.tar.gz, so a client does not undo an encoding it did not ask for.
+ENCODED_FILE_TYPES = {'gzip': 'application/gzip', 'bzip2': 'application/x-bzip2',
+					  'xz': 'application/x-xz'}
+
+def guess_type(path):
+	content_type, encoding = mimetypes.guess_type(path)
+	if encoding is not None:
+		return ENCODED_FILE_TYPES.get(encoding, 'application/octet-stream')
+	return content_type or 'application/octet-stream'
+
+def compressible(content_type):
+	content_type = content_type.split(';')[0].strip()
+	return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+def choose_encoding(accept_encoding):
+	'''
+	The Content-Encoding to use for a request's Accept-Encoding header:
+	'gzip', 'deflate', or None to send the body as it is.
+	'''
+	if not accept_encoding:
+		return None
+	qualities = {}
+	for item in accept_encoding.split(','):
+		coding, _, params = item.partition(';')
+		quality = 1.0
+		for param in params.split(';'):
+			name, _, value = param.partition('=')
+			if name.strip().lower() == 'q':
+				try:
+					quality = float(value)
+				except ValueError:
+					quality = 0.0
+		qualities[coding.strip().lower()] = quality
+	qualities.setdefault('gzip', qualities.get('x-gzip', qualities.get('*', 0.0)))
+	qualities.setdefault('deflate', qualities.get('*', 0.0))
+	best = max(('gzip', 'deflate'), key=lambda coding: qualities[coding]) # gzip on a tie
+	return best if qualities[best] > 0 else None
+
+def compress(content, encoding):
+	if encoding == 'gzip':
+		return gzip.compress(content, mtime=0) # same bytes, and ETag, every time
+	return zlib.compress(content) # HTTP's "deflate" is the zlib format
+
+def query_int(query, name, default, low, high):
+	'''The integer query parameter name, clamped to [low, high].'''
+	try:
+		value = int(query[name][-1])
+	except (KeyError, ValueError):
+		return default
+	return max(low, min(value, high))
+
+def listing_item(entry):
+	name = html.escape(entry.name)
+	try:
+		if entry.is_dir(): # from the directory entry's type, no stat
+			return '<li>{0}/</li>'.format(name)
+		size = entry.stat().st_size # one stat, kept by the DirEntry
+	except OSError: # gone since the scan, or a dangling link
+		return '<li>{0}</li>'.format(name)
+	return '<li>{0} ({1} bytes)</li>'.format(name, size)
 
 class base_case(object):
 	'''Parent class for case handlers.'''
 
-	def handle_file(self, handler, absolute_path):
+	def handle_file(self, handler, absolute_path, stat=None):
 		try:
-			with open(absolute_path, 'rb') as reader: # reading the file as binary
-				content = reader.read() # for GB sized data (videos), consider streaming data
-			handler.send_content(content)
+			handler.send_static_file(absolute_path, stat)
 		except IOError as msg:
-			msg = "'{0}' cannot be read: {1}".format(self.path, msg)
-			self.handle_error(msg)
+			if handler.response_started:
+				# e.g. the client went away mid-sendfile; an error page now
+				# would land inside the half-sent body, so let do_GET log it
+				# and close the connection.
+				raise
+			msg = "'{0}' cannot be read: {1}".format(handler.path, msg)
+			handler.handle_error(msg)
 
 	def list_dir(self, handler, absolute_path):
 		try:
-			entries = os.listdir(absolute_path)
-			bullets = ['<li>{0}</li>'.format(e) for e in entries 
-					   if not e.startswith('.')]
-			page = handler.Listing_Page.format('\n'.join(bullets)).encode('utf-8')
-			handler.send_content(page)
+			stat = handler.resolved.stat or os.stat(absolute_path)
+			entries = handler.Listing_Cache.get(absolute_path, stat)
+			if entries is None:
+				with os.scandir(absolute_path) as scan:
+					entries = sorted((e for e in scan if not e.name.startswith('.')),
+									 key=lambda e: e.name)
+				handler.Listing_Cache.put(absolute_path, stat, entries)
 		except OSError as msg:
-			msg = "'{0}' cannot be listed: {1}".format(self.path, msg)
-			self.handle_error(msg)
+			msg = "'{0}' cannot be listed: {1}".format(handler.path, msg)
+			handler.handle_error(msg)
+			return
+		handler.send_listing(entries)
 
 	def run_cgi(self, handler, absolute_path):
-		cmd = ['python', absolute_path]
-		p = subprocess.Popen(cmd, stdin=subprocess.PIPE,stdout=subprocess.PIPE)
-		output, err = p.communicate()
-		handler.send_content(output)
+		handler.send_cgi(absolute_path) # the serving engine decides how to run it
 
 	def index_path(self, handler):
 		return os.path.join(handler.absolute_path, 'index.html')
@@ -49,7 +366,7 @@ class case_no_file(base_case):
 	'''File or directory does not exist.'''
 
 	def test(self, handler):
-		return not os.path.exists(handler.absolute_path)
+		return not handler.resolved.exists
 
 	def act(self, handler):
 		raise ServerException("'{0}' not found".format(handler.path))
@@ -58,27 +375,28 @@ class case_existing_file(base_case):
 	'''File exists.'''
 
 	def test(self, handler):
-		return os.path.isfile(handler.absolute_path)
+		return handler.resolved.is_file
 
 	def act(self, handler):
-		self.handle_file(handler, handler.absolute_path)
+		self.handle_file(handler, handler.absolute_path, handler.resolved.stat)
 
 class case_directory_index_file(base_case):
 	'''Server index.html page for a directory.'''
 
 	def test(self, handler):
-		return os.path.isdir(handler.absolute_path) and \
-			   os.path.isfile(self.index_path(handler))
+		return handler.resolved.is_dir and \
+			   handler.resolved.index_is_file(self.index_path(handler))
 
 	def act(self, handler):
-		self.handle_file(handler, self.index_path(handler))
+		index_path = self.index_path(handler)
+		self.handle_file(handler, index_path, handler.resolved.index_stat(index_path))
 
 class case_directory_no_index_file(base_case):
 	'''Serve listing for a directory without an index.html page.'''
 
 	def test(self, handler):
-		return os.path.isdir(handler.absolute_path) and \
-			   not os.path.isfile(self.index_path(handler))
+		return handler.resolved.is_dir and \
+			   not handler.resolved.index_is_file(self.index_path(handler))
 
 	def act(self, handler):
 		self.list_dir(handler, handler.absolute_path)
@@ -87,8 +405,8 @@ class case_cgi_file(base_case):
 	'''Something executable.'''
 
 	def test(self, handler):
-		return os.path.isfile(handler.absolute_path) and \
-			   handler.absolute_path.endswith('.py')
+		return handler.absolute_path.endswith('.py') and \
+			   handler.resolved.is_file
 
 	def act(self, handler):
 		self.run_cgi(handler, handler.absolute_path)
@@ -113,8 +431,19 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 	'''
 	If the requested path maps to a file, that file is served.
 	If anything goes wrong, an error page is constructed.
+
+	Speaks HTTP/1.1, so a client may send further (or pipelined) requests
+	on the same connection until it has sat idle for timeout seconds or
+	Max_Requests have been answered.
 	'''
 
+	protocol_version = 'HTTP/1.1'
+	timeout = 15.0 # idle seconds before a kept-alive connection is dropped
+	Max_Requests = 100 # per connection
+	Keep_Alive = True # off in serial mode, where an idle client blocks everyone
+	Idle_Poll = 0.1 # seconds a pooled worker waits for the next request
+	Max_Discarded_Body = 1 << 20 # larger GET bodies close the connection
+
 	Cases = [case_no_file(),
 			 case_cgi_file(),
 			 case_existing_file(),
@@ -125,11 +454,38 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 	Listing_Page = '''\
 		<html>
 			<body>
-				<ul>{0}</ul>
+				<ul>{entries}</ul>
+				<p>{pages}</p>
 			</body>
 		</html>
 	'''
 
+	CHUNK_SIZE = 64 * 1024
+
+	File_Cache = FileCache() # shared by every request
+	Compress_Min_Size = 1024 # smaller bodies are not worth compressing
+	Compress_Max_Size = 4 * 1024 * 1024 # larger files are streamed as they are
+	# Compressed files, keyed by (path, encoding). Only files up to
+	# Compress_Max_Size get here, so any single variant may be cached;
+	# incompressible ones come out a little larger than they went in.
+	Compressed_Cache = FileCache(max_bytes=32 * 1024 * 1024,
+								 max_file_size=32 * 1024 * 1024)
+	Max_Ranges = 16 # more (after merging) get the whole body instead
+
+	# Sorted os.scandir entries per directory, used while the directory's
+	# mtime is unchanged. Sizes here count entries, not bytes, and there is
+	# no per-directory cap: the biggest directories are the ones that most
+	# need caching, so the last one listed is kept however large it is.
+	Listing_Cache = FileCache(max_bytes=1 << 19, max_file_size=None)
+	Listing_Page_Size = 1000 # entries per page unless ?per_page= says otherwise
+	Max_Listing_Page_Size = 10000
+
+	Root = None # directory served, or None for the current one
+	Route_Cache = None # a RouteCache, or None to resolve every request
+
+	Cgi_Pool = None # a CgiPool, or None to start a process per request
+	Cgi_Timeout = None # seconds
+
 	Error_Page = '''\
 		<html>
 			<body>
@@ -139,38 +495,888 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 		</html>
 	'''
 
-	def send_content(self, content, status=200):
+	def send_content(self, content, status=200, headers=(), content_type="text/html"):
+		content, headers = self.encode_content(content, content_type, headers)
 		self.send_response(status)
-		self.send_header("Content-Type", "text/html")
+		self.send_header("Content-Type", content_type)
 		self.send_header("Content-Length", str(len(content)))
+		for keyword, value in headers:
+			self.send_header(keyword, value)
 		self.end_headers()
 		self.wfile.write(content) # Strings in Python3 are Unicode so have to convert to binary
 
-	def handle_error(self, msg):
+	def encode_content(self, content, content_type, headers):
+		# Generated pages (listings, errors, CGI output) are compressed here
+		# on every request. Static files carry an ETag for the encoding they
+		# were chosen in, so they are never re-encoded here.
+		headers = list(headers)
+		keywords = set(keyword.lower() for keyword, _ in headers)
+		if 'content-encoding' in keywords or 'etag' in keywords or \
+		   not compressible(content_type) or \
+		   len(content) < self.Compress_Min_Size:
+			return content, headers
+		if 'vary' not in keywords:
+			headers.append(('Vary', 'Accept-Encoding'))
+		encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+		if encoding is not None:
+			content = compress(content, encoding)
+			headers.append(('Content-Encoding', encoding))
+		return content, headers
+
+	def send_stream(self, pieces, status=200, headers=(), content_type="text/html"):
+		'''
+		Send a body of unknown length as pieces (str or bytes) of it are
+		generated: chunked to HTTP/1.1 clients, ended by closing the
+		connection otherwise. Pieces are gathered into CHUNK_SIZE writes and
+		compressed as they go when the client accepts it.
+		'''
+		headers = list(headers)
+		compressor = None
+		if compressible(content_type):
+			headers.append(('Vary', 'Accept-Encoding'))
+			encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+			if encoding is not None:
+				# wbits 31 writes a gzip header and trailer, 15 a zlib one
+				compressor = zlib.compressobj(wbits=31 if encoding == 'gzip' else 15)
+				headers.append(('Content-Encoding', encoding))
+		chunked = self.request_version == 'HTTP/1.1'
+		if not chunked:
+			self.close_connection = True
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		if chunked:
+			self.send_header("Transfer-Encoding", "chunked")
+		for keyword, value in headers:
+			self.send_header(keyword, value)
+		self.end_headers()
+		buffer = bytearray()
+		for piece in pieces:
+			if isinstance(piece, str):
+				piece = piece.encode('utf-8')
+			buffer += compressor.compress(piece) if compressor is not None else piece
+			if len(buffer) >= self.CHUNK_SIZE:
+				self.write_chunk(buffer, chunked)
+				buffer = bytearray()
+		if compressor is not None:
+			buffer += compressor.flush()
+		if buffer:
+			self.write_chunk(buffer, chunked)
+		if chunked:
+			self.wfile.write(b'0\r\n\r\n')
+
+	def write_chunk(self, data, chunked):
+		if chunked:
+			self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+		else:
+			self.wfile.write(data)
+
+	def send_listing(self, entries):
+		'''
+		Stream one page of a directory listing, picked by the page and
+		per_page query parameters, so a huge directory never becomes one
+		huge page. Only the entries on the page are stat'ed for their size.
+		'''
+		query = urllib.parse.parse_qs(self.query)
+		per_page = query_int(query, 'per_page', self.Listing_Page_Size,
+							 1, self.Max_Listing_Page_Size)
+		pages = max(1, (len(entries) + per_page - 1) // per_page)
+		page = query_int(query, 'page', 1, 1, pages)
+		shown = entries[(page - 1) * per_page:page * per_page]
+		head, tail = self.Listing_Page.split('{entries}')
+
+		def pieces():
+			yield head
+			for entry in shown:
+				yield listing_item(entry)
+				yield '\n'
+			yield tail.format(pages=self.listing_pages(page, pages, per_page,
+														len(entries), len(shown)))
+		self.send_stream(pieces())
+
+	def listing_pages(self, page, pages, per_page, total, shown):
+		first = (page - 1) * per_page
+		links = ['{0}-{1} of {2}'.format(first + 1 if shown else 0, first + shown, total)]
+		link = '<a href="?page={0}&amp;per_page={1}">{2}</a>'
+		if page > 1:
+			links.append(link.format(page - 1, per_page, 'previous'))
+		if page < pages:
+			links.append(link.format(page + 1, per_page, 'next'))
+		return ' '.join(links)
+
+	def send_file(self, reader, status=200, headers=(), content_type="text/html"):
+		size = os.fstat(reader.fileno()).st_size
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(size))
+		for keyword, value in headers:
+			self.send_header(keyword, value)
+		self.end_headers()
+		self.copy_file(reader, 0, size)
+
+	def send_static_file(self, absolute_path, stat=None):
+		'''
+		Serve a file from disk with its guessed Content-Type, ETag and
+		Last-Modified validators, answering a matching conditional GET with
+		a bodiless 304. Compressible types go out gzip'ed or deflated when
+		the client accepts it: from a fresh enough .gz sibling on disk if
+		there is one, otherwise compressed once into Compressed_Cache.
+		Small files come from File_Cache while their mtime and size are
+		unchanged, so a hit or a 304 costs one stat and no open, or none
+		when the caller already has a stat.
+		'''
+		if stat is None:
+			stat = os.stat(absolute_path)
+		content_type = guess_type(absolute_path)
+		if not compressible(content_type):
+			self.send_cached_file(absolute_path, stat, content_type)
+			return
+		headers = [('Vary', 'Accept-Encoding')]
+		encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+		if encoding == 'gzip':
+			precompressed = absolute_path + '.gz'
+			gz_stat = stat_or_none(precompressed)
+			if gz_stat is not None and stat_module.S_ISREG(gz_stat.st_mode) and \
+			   gz_stat.st_mtime_ns >= stat.st_mtime_ns:
+				self.send_cached_file(precompressed, gz_stat, content_type, headers, 'gzip')
+				return
+		# Bytes compressed on the fly are not stored anywhere a Range could
+		# index, so a Range that will be honoured gets the file as it is.
+		# One that is ignored (stale If-Range, bad spec) gets the usual
+		# full response, compressed variant included.
+		ranged = self.byte_ranges(stat.st_size, validators(stat)[0], stat.st_mtime) is not None
+		if encoding is not None and not ranged and \
+		   self.Compress_Min_Size <= stat.st_size <= self.Compress_Max_Size:
+			self.send_compressed_file(absolute_path, stat, content_type, headers, encoding)
+			return
+		self.send_cached_file(absolute_path, stat, content_type, headers)
+
+	def send_cached_file(self, absolute_path, stat, content_type, headers=(), encoding=None):
+		# encoding is the Content-Encoding the file on disk already has.
+		etag, _ = validators(stat, encoding)
+		if self.not_modified(etag, stat.st_mtime):
+			self.send_not_modified(stat, headers, encoding)
+			return
+		headers = self.entity_headers(stat, headers, encoding) + [('Accept-Ranges', 'bytes')]
+		ranges = self.byte_ranges(stat.st_size, etag, stat.st_mtime)
+		if ranges is not None:
+			self.send_ranges(absolute_path, stat, content_type, headers, ranges)
+			return
+		content = self.File_Cache.get(absolute_path, stat)
+		if content is None:
+			with open(absolute_path, 'rb') as reader: # reading the file as binary
+				if os.fstat(reader.fileno()).st_size > self.File_Cache.max_file_size:
+					# streamed, so GB sized files (videos) never sit in memory
+					self.send_file(reader, headers=headers, content_type=content_type)
+					return
+				content = reader.read()
+			if len(content) == stat.st_size: # unchanged since the stat
+				self.File_Cache.put(absolute_path, stat, content)
+		self.send_content(content, headers=headers, content_type=content_type)
+
+	def byte_ranges(self, size, etag, mtime):
+		'''
+		The (first, last) byte positions a Range header asks for, clipped to
+		size and with overlapping ranges merged. None means send the whole
+		body: no Range, a stale If-Range, or a header we do not understand.
+		An empty list means none of the ranges can be satisfied.
+		'''
+		header = self.headers.get('Range')
+		if header is None or not self.if_range(etag, mtime):
+			return None
+		unit, _, specs = header.partition('=')
+		if unit.strip().lower() != 'bytes':
+			return None
+		ranges = []
+		for spec in specs.split(','):
+			first, dash, last = spec.strip().partition('-')
+			if not dash or not (first + last).isdigit():
+				return None
+			if not first: # the last N bytes
+				if int(last) > 0 and size > 0:
+					ranges.append((max(0, size - int(last)), size - 1))
+			elif last and int(last) < int(first):
+				return None
+			elif int(first) < size:
+				ranges.append((int(first), min(int(last) if last else size - 1, size - 1)))
+		merged = []
+		for first, last in sorted(ranges):
+			if merged and first <= merged[-1][1] + 1:
+				merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+			else:
+				merged.append((first, last))
+		if len(merged) > self.Max_Ranges:
+			return None
+		return merged
+
+	def if_range(self, etag, mtime):
+		# A Range only applies to the representation the client already has
+		# part of; anything else, including a weak tag, gets the whole body.
+		if_range = self.headers.get('If-Range')
+		if if_range is None:
+			return True
+		if_range = if_range.strip()
+		if if_range.startswith('"') or if_range.startswith('W/'):
+			return if_range == etag
+		try:
+			date = email.utils.parsedate_to_datetime(if_range)
+		except (TypeError, ValueError):
+			return False
+		if date is None or date.tzinfo is None:
+			return False
+		return int(mtime) == date.timestamp()
+
+	def send_ranges(self, absolute_path, stat, content_type, headers, ranges):
+		'''
+		Send a 206 with the requested ranges copied straight from the file,
+		as multipart/byteranges when there is more than one, or a 416 when
+		there are none.
+		'''
+		size = stat.st_size
+		if not ranges:
+			self.send_content(b'', 416, headers + [('Content-Range', 'bytes */{0}'.format(size))],
+							  content_type=content_type)
+			return
+		with open(absolute_path, 'rb') as reader:
+			if len(ranges) == 1:
+				first, last = ranges[0]
+				self.send_response(206)
+				self.send_header("Content-Type", content_type)
+				self.send_header("Content-Length", str(last - first + 1))
+				self.send_header("Content-Range", 'bytes {0}-{1}/{2}'.format(first, last, size))
+				for keyword, value in headers:
+					self.send_header(keyword, value)
+				self.end_headers()
+				self.copy_file(reader, first, last - first + 1)
+				return
+			boundary = uuid.uuid4().hex
+			parts = [('\r\n--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n'.format(
+						  boundary, content_type, first, last, size).encode('latin-1'), first, last)
+					 for first, last in ranges]
+			trailer = '\r\n--{0}--\r\n'.format(boundary).encode('latin-1')
+			length = sum(len(head) + last - first + 1 for head, first, last in parts) + len(trailer)
+			self.send_response(206)
+			self.send_header("Content-Type", 'multipart/byteranges; boundary=' + boundary)
+			self.send_header("Content-Length", str(length))
+			for keyword, value in headers:
+				self.send_header(keyword, value)
+			self.end_headers()
+			for head, first, last in parts:
+				self.wfile.write(head)
+				self.copy_file(reader, first, last - first + 1)
+			self.wfile.write(trailer)
+
+	def send_compressed_file(self, absolute_path, stat, content_type, headers, encoding):
+		etag, _ = validators(stat, encoding)
+		if self.not_modified(etag, stat.st_mtime):
+			self.send_not_modified(stat, headers, encoding)
+			return
+		key = (absolute_path, encoding)
+		content = self.Compressed_Cache.get(key, stat)
+		if content is None:
+			with open(absolute_path, 'rb') as reader:
+				stat = os.fstat(reader.fileno())
+				content = compress(reader.read(), encoding)
+			self.Compressed_Cache.put(key, stat, content)
+		self.send_content(content, headers=self.entity_headers(stat, headers, encoding),
+						  content_type=content_type)
+
+	def entity_headers(self, stat, headers=(), encoding=None):
+		etag, last_modified = validators(stat, encoding)
+		entity = [('ETag', etag), ('Last-Modified', last_modified)] + list(headers)
+		if encoding is not None:
+			entity.append(('Content-Encoding', encoding))
+		return entity
+
+	def send_not_modified(self, stat, headers=(), encoding=None):
+		self.send_response(304)
+		etag, last_modified = validators(stat, encoding)
+		for keyword, value in [('ETag', etag), ('Last-Modified', last_modified)] + list(headers):
+			self.send_header(keyword, value)
+		self.end_headers()
+
+	def not_modified(self, etag, mtime):
+		# If-None-Match wins over If-Modified-Since when both are sent.
+		if_none_match = self.headers.get('If-None-Match')
+		if if_none_match is not None:
+			tags = [tag.strip() for tag in if_none_match.split(',')]
+			return '*' in tags or etag in tags or 'W/' + etag in tags
+		if_modified_since = self.headers.get('If-Modified-Since')
+		if if_modified_since is None:
+			return False
+		try:
+			since = email.utils.parsedate_to_datetime(if_modified_since)
+		except (TypeError, ValueError):
+			return False
+		if since is None or since.tzinfo is None:
+			return False
+		return int(mtime) <= since.timestamp()
+
+	def copy_file(self, reader, offset, count):
+		'''
+		Copy count bytes of reader from offset to the client. socket.sendfile
+		uses os.sendfile where the platform has it, so the bytes go from the
+		page cache to the socket without passing through Python, and falls
+		back to sending CHUNK_SIZE reads otherwise.
+		'''
+		self.wfile.flush()
+		if hasattr(self.connection, 'sendfile'):
+			sent = self.connection.sendfile(reader, offset, count)
+		else: # not a plain socket
+			sent = 0
+			reader.seek(offset)
+			while sent < count:
+				chunk = reader.read(min(self.CHUNK_SIZE, count - sent))
+				if not chunk:
+					break
+				self.wfile.write(chunk)
+				sent += len(chunk)
+		if sent < count:
+			# The file shrank under us; the client must not wait for the rest.
+			self.close_connection = True
+
+	def send_cgi(self, absolute_path):
+		try:
+			if self.Cgi_Pool is not None:
+				output = self.Cgi_Pool.run(absolute_path)
+			else:
+				cmd = ['python', absolute_path]
+				p = subprocess.Popen(cmd, stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+				try:
+					output, err = p.communicate(timeout=self.Cgi_Timeout)
+				except subprocess.TimeoutExpired:
+					p.kill()
+					p.communicate()
+					raise CgiTimeout("'{0}' took longer than {1}s".format(
+						absolute_path, self.Cgi_Timeout))
+		except CgiTimeout as msg:
+			self.handle_error(msg, 504)
+			return
+		self.send_content(output)
+
+	def handle_error(self, msg, status=404):
 		content = self.Error_Page.format(path = self.path, msg = msg).encode('utf-8')
-		self.send_content(content, 404)
+		self.send_content(content, status)
+
+	def handle(self):
+		self.requests_handled = 0
+		self.parked = False
+		super().handle()
+
+	def resume(self):
+		'''
+		Carry on serving a connection PooledHTTPServer parked while it was
+		idle, now that the client has sent more.
+		'''
+		self.parked = False
+		self.close_connection = False
+		try:
+			while not self.close_connection:
+				self.handle_one_request()
+		finally:
+			self.finish()
+
+	def finish(self):
+		if not self.parked: # its files stay open until resume()
+			super().finish()
+
+	def handle_one_request(self):
+		if self.requests_handled and self.idle():
+			self.parked = True
+			self.close_connection = True # ends the loop, not the connection
+			return
+		self.requests_handled += 1
+		self.response_started = False
+		super().handle_one_request()
+
+	def idle(self):
+		# Between requests on a pooled server: True if the client has sent
+		# nothing within Idle_Poll seconds, so the worker can go back to the
+		# pool instead of waiting out the whole idle timeout.
+		if getattr(self.server, 'park', None) is None or self.request_buffered():
+			return False
+		return not select.select([self.connection], [], [], self.Idle_Poll)[0]
+
+	def request_buffered(self):
+		# A pipelined request may already sit in rfile's buffer, where
+		# select cannot see it. Peeking on a non-blocking socket returns
+		# what is buffered, or whatever can be read without waiting.
+		self.connection.settimeout(0)
+		try:
+			return bool(self.rfile.peek(1))
+		finally:
+			self.connection.settimeout(self.timeout)
+
+	def send_response(self, code, message=None):
+		self.response_started = True
+		super().send_response(code, message)
+
+	def end_headers(self):
+		# Every response we send is framed by Content-Length, chunked, or
+		# has no body, so only whether the connection stays open needs
+		# saying.
+		if not self.close_connection and (not self.Keep_Alive or
+				self.requests_handled >= self.Max_Requests or self.server_saturated()):
+			self.send_header('Connection', 'close')
+		elif not self.close_connection and self.request_version == 'HTTP/1.0':
+			self.send_header('Connection', 'keep-alive')
+		super().end_headers()
+
+	def server_saturated(self):
+		# A kept-alive connection holds its worker while idle, so give the
+		# worker back when other connections are queued for one.
+		saturated = getattr(self.server, 'saturated', None)
+		return saturated is not None and saturated()
+
+	def skip_body(self):
+		# A GET body left unread would be parsed as the next request.
+		if self.headers.get('Transfer-Encoding'):
+			self.close_connection = True
+			return
+		length = int(self.headers.get('Content-Length') or 0)
+		if length > self.Max_Discarded_Body:
+			self.close_connection = True
+		elif length > 0:
+			self.rfile.read(length)
 
 	# Handles a GET request
 	def do_GET(self):
 		try:
+			self.skip_body()
 
 			# figure out what exactly is being requested.
-			self.absolute_path = os.getcwd() + self.path
+			root = self.Root if self.Root is not None else os.getcwd()
+			path, _, self.query = self.path.partition('?')
+			self.absolute_path = root + path
+			route = self.Route_Cache.get(path) if self.Route_Cache is not None else None
 
 			# figure out how to handle it
-			for case in self.Cases: # for loop replaces a series of if statements
-				if case.test(self):
-					case.act(self)
-					break
+			if route is not None:
+				case, self.resolved = route
+			else:
+				self.resolved = Resolved(self.absolute_path) # the one stat
+				for case in self.Cases: # for loop replaces a series of if statements
+					if case.test(self):
+						break
+				if self.Route_Cache is not None:
+					self.Route_Cache.put(path, case, self.resolved)
+			case.act(self)
 
 		# handle exceptions
+		except Exception as msg:
+			if self.response_started:
+				# Part of a response is already out, so an error page would
+				# corrupt the framing; end the connection instead.
+				self.log_error("%s after response began", msg)
+				self.close_connection = True
+			else:
+				self.handle_error(msg)
+
+class PooledHTTPServer(http.server.HTTPServer):
+	'''
+	Accepts connections on the main thread and hands them to a fixed pool
+	of worker threads through a bounded queue, so one slow client or CGI
+	script only ties up one worker. Connections that arrive while the
+	queue is full get a 503 instead of waiting behind it.
+
+	A kept-alive connection that goes quiet between requests is parked:
+	its worker returns to the pool, and a watcher thread queues the
+	connection again once the client sends more, or closes it after the
+	handler's idle timeout.
+	'''
+
+	Busy_Response = (b'HTTP/1.0 503 Service Unavailable\r\n'
+					 b'Content-Type: text/html\r\n'
+					 b'Content-Length: 0\r\n'
+					 b'Connection: close\r\n\r\n')
+
+	def __init__(self, server_address, handler_class, workers=8, backlog=64,
+				 max_queue=64):
+		self.request_queue_size = backlog # listen() backlog
+		super().__init__(server_address, handler_class)
+		self._requests = queue.Queue(max_queue)
+		self._parked = []
+		self._parked_lock = threading.Lock()
+		self._closing = False
+		self._wakeup, self._wakeup_writer = socket.socketpair()
+		self._watcher = threading.Thread(target=self._watch, daemon=True)
+		self._watcher.start()
+		self._workers = [threading.Thread(target=self._work, daemon=True)
+						 for _ in range(workers)]
+		for worker in self._workers:
+			worker.start()
+
+	def process_request(self, request, client_address):
+		try:
+			self._requests.put_nowait((request, client_address, None))
+		except queue.Full:
+			try:
+				request.sendall(self.Busy_Response)
+			except OSError:
+				pass
+			self.shutdown_request(request)
+
+	def saturated(self):
+		return not self._requests.empty()
+
+	def park(self, handler):
+		# Only called from _work, once the handler has fully returned, so
+		# the watcher can never resume it on another thread too early.
+		with self._parked_lock:
+			self._parked.append(handler)
+		self._wakeup_writer.send(b'\0')
+
+	def _work(self):
+		while True:
+			item = self._requests.get()
+			if item is None:
+				break
+			request, client_address, handler = item
+			parked = False
+			try:
+				if handler is None:
+					handler = self.RequestHandlerClass(request, client_address, self)
+				else:
+					handler.resume()
+				parked = handler.parked
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				if not parked:
+					self.shutdown_request(request)
+				elif self._closing:
+					self._close_parked(handler)
+				else:
+					self.park(handler)
+
+	def _watch(self):
+		selector = selectors.DefaultSelector()
+		selector.register(self._wakeup, selectors.EVENT_READ)
+		deadlines = {}
+		while True:
+			soonest = min(deadlines.values(), default=float('inf'))
+			timeout = None if soonest == float('inf') else max(0, soonest - time.monotonic())
+			for key, _ in selector.select(timeout):
+				if key.fileobj is self._wakeup:
+					self._wakeup.recv(4096)
+					with self._parked_lock:
+						parked, self._parked = self._parked, []
+					for handler in parked:
+						selector.register(handler.connection, selectors.EVENT_READ, handler)
+						deadlines[handler] = (time.monotonic() + handler.timeout
+											  if handler.timeout else float('inf'))
+				else: # the client sent its next request, or hung up
+					selector.unregister(key.fileobj)
+					del deadlines[key.data]
+					self._requests.put((key.fileobj, key.data.client_address, key.data))
+			now = time.monotonic()
+			for handler, deadline in list(deadlines.items()):
+				if self._closing or deadline <= now:
+					selector.unregister(handler.connection)
+					del deadlines[handler]
+					self._close_parked(handler)
+			if self._closing:
+				selector.close()
+				return
+
+	def _close_parked(self, handler):
+		handler.parked = False
+		try:
+			handler.finish()
+		except OSError:
+			pass
+		self.shutdown_request(handler.connection)
+
+	def server_close(self):
+		'''
+		Stop listening, close idle kept-alive connections, then let the
+		workers finish every request already accepted before returning.
+		'''
+		super().server_close()
+		self._closing = True
+		self._wakeup_writer.send(b'\0')
+		self._watcher.join()
+		for _ in self._workers:
+			self._requests.put(None)
+		for worker in self._workers:
+			worker.join()
+		for handler in self._parked: # parked by workers after the watcher left
+			self._close_parked(handler)
+		self._wakeup.close()
+		self._wakeup_writer.close()
+
+class ResponseBuffer(object):
+	'''
+	Stands in for wfile. Holds a response as bytes and (file, offset,
+	count) slices until the event loop can write it out.
+	'''
+
+	def __init__(self):
+		self.parts = []
+
+	def write(self, data):
+		self.parts.append(bytes(data))
+
+	def write_file(self, reader, offset, count):
+		# The case closes its file once it returns, so keep our own handle.
+		self.parts.append((os.fdopen(os.dup(reader.fileno()), 'rb'), offset, count))
+
+	def flush(self):
+		pass
+
+	def close(self):
+		for part in self.parts:
+			if isinstance(part, tuple):
+				part[0].close()
+		self.parts = []
+
+class AsyncRequestHandler(RequestHandler):
+	'''
+	RequestHandler for one request read by AsyncHTTPServer. The request
+	line and headers are parsed by http.server as usual and the Cases run
+	unchanged, but everything they send lands in a ResponseBuffer, and a
+	CGI script is only noted here and run later as an asyncio subprocess.
+	'''
+
+	def __init__(self, head, client_address, server, requests_handled=1):
+		self.client_address = client_address
+		self.server = server
+		self.rfile = io.BytesIO(head)
+		self.wfile = ResponseBuffer()
+		self.cgi_path = None
+		self.close_connection = True
+		self.requests_handled = requests_handled
+		self.response_started = False
+
+	def parse(self):
+		'''
+		Parse the buffered head. Returns the do_ method to call, or None if
+		an error response has already been buffered.
+		'''
+		self.raw_requestline = self.rfile.readline(65537)
+		if not self.parse_request():
+			return None
+		method = getattr(self, 'do_' + self.command, None)
+		if method is None:
+			self.send_error(501, "Unsupported method ({0!r})".format(self.command))
+		return method
+
+	def skip_body(self):
+		pass # AsyncHTTPServer has already read it
+
+	def copy_file(self, reader, offset, count):
+		self.wfile.write_file(reader, offset, count)
+
+	def send_cgi(self, absolute_path):
+		self.cgi_path = absolute_path
+
+	async def run_cgi(self):
+		try:
+			if self.Cgi_Pool is not None:
+				output = await asyncio.get_running_loop().run_in_executor(
+					None, self.Cgi_Pool.run, self.cgi_path)
+			else:
+				process = await asyncio.create_subprocess_exec(
+					'python', self.cgi_path,
+					stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+				try:
+					output, err = await asyncio.wait_for(
+						process.communicate(), self.Cgi_Timeout)
+				except asyncio.TimeoutError:
+					process.kill()
+					await process.wait()
+					raise CgiTimeout("'{0}' took longer than {1}s".format(
+						self.cgi_path, self.Cgi_Timeout))
+		except CgiTimeout as msg:
+			self.handle_error(msg, 504)
 		except Exception as msg:
 			self.handle_error(msg)
+		else:
+			self.send_content(output)
+
+class AsyncHTTPServer(object):
+	'''
+	Serves every connection from one event loop, with HTTP/1.1 framing and
+	keep-alive done here over asyncio streams. An idle connection costs a
+	coroutine, not a thread. The Cases still run synchronously, so each
+	one is handed to the loop's default executor along with its stats and
+	opens; file bodies go out through loop.sendfile and CGI scripts run as
+	asyncio subprocesses.
+	'''
+
+	MAX_HEAD = 65536 # request line plus headers
+	MAX_BODY = 1 << 20 # request bodies are read and dropped
+
+	def __init__(self, server_address, handler_class=AsyncRequestHandler,
+				 backlog=64, idle_timeout=15.0, max_requests=100):
+		self.server_address = server_address
+		self.handler_class = handler_class
+		self.backlog = backlog
+		self.idle_timeout = idle_timeout
+		self.max_requests = max_requests
+		self._server = None
+		self._idle = {} # connection task -> waiting for a request
+		self._closing = False
+
+	async def serve_forever(self):
+		loop = asyncio.get_running_loop()
+		host, port = self.server_address
+		self._server = await asyncio.start_server(
+			self._serve_connection, host or None, port,
+			backlog=self.backlog, limit=self.MAX_HEAD)
+		for signum in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(signum, self.shutdown)
+		try:
+			await self._server.serve_forever()
+		except asyncio.CancelledError:
+			pass
+		await self._drain()
+
+	def shutdown(self):
+		'''
+		Stop accepting, close idle connections and let busy ones finish
+		their current request.
+		'''
+		self._closing = True
+		self._server.close()
+		for task, idle in list(self._idle.items()):
+			if idle:
+				task.cancel()
+
+	async def _drain(self):
+		await self._server.wait_closed()
+		if self._idle:
+			await asyncio.gather(*self._idle, return_exceptions=True)
+
+	async def _serve_connection(self, reader, writer):
+		task = asyncio.current_task()
+		self._idle[task] = True
+		requests_handled = 0
+		try:
+			while not self._closing and requests_handled < self.max_requests:
+				self._idle[task] = True
+				try:
+					head = await asyncio.wait_for(
+						reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+				except asyncio.LimitOverrunError:
+					writer.write(b'HTTP/1.1 431 Request Header Fields Too Large\r\n'
+								 b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+					break
+				except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+						asyncio.CancelledError, ConnectionError):
+					break
+				self._idle[task] = False
+				requests_handled += 1
+				handler = self.handler_class(
+					head, writer.get_extra_info('peername'), self, requests_handled)
+				handler.Max_Requests = self.max_requests
+				if not await self._handle(handler, reader, writer):
+					break
+		finally:
+			del self._idle[task]
+			writer.close()
+
+	async def _handle(self, handler, reader, writer):
+		# Returns whether the connection can carry another request.
+		loop = asyncio.get_running_loop()
+		try:
+			method = handler.parse()
+			if method is not None:
+				length = int(handler.headers.get('Content-Length') or 0)
+				if handler.headers.get('Transfer-Encoding'):
+					handler.send_error(411) # no chunked GET bodies
+				elif not 0 <= length <= self.MAX_BODY:
+					handler.send_error(413)
+				else:
+					await reader.readexactly(length)
+					await loop.run_in_executor(None, method)
+					if handler.cgi_path is not None:
+						await handler.run_cgi()
+			await self._write(writer, handler.wfile.parts)
+			return not handler.close_connection
+		except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+			return False
+		finally:
+			handler.wfile.close()
+
+	async def _write(self, writer, parts):
+		loop = asyncio.get_running_loop()
+		for part in parts:
+			if isinstance(part, bytes):
+				writer.write(part)
+			else:
+				reader, offset, count = part
+				await writer.drain()
+				# os.sendfile on the socket where possible, else reads run in
+				# the default executor.
+				await loop.sendfile(writer.transport, reader, offset, count)
+		await writer.drain()
+
+def make_server(options):
+	serverAddress = ('', options.port)
+	RequestHandler.Root = os.getcwd()
+	RequestHandler.timeout = options.idle_timeout
+	RequestHandler.Max_Requests = options.max_requests
+	RequestHandler.Keep_Alive = options.mode != 'serial'
+	if options.route_ttl > 0:
+		RequestHandler.Route_Cache = RouteCache(options.route_ttl)
+	RequestHandler.Cgi_Timeout = options.cgi_timeout
+	if options.cgi_workers:
+		RequestHandler.Cgi_Pool = CgiPool(options.cgi_workers, options.cgi_timeout)
+	if options.mode == 'asyncio':
+		return AsyncHTTPServer(serverAddress, AsyncRequestHandler, options.backlog,
+							   options.idle_timeout, options.max_requests)
+	if options.mode == 'threads':
+		return PooledHTTPServer(serverAddress, RequestHandler, options.workers,
+								options.backlog, options.queue)
+	return http.server.HTTPServer(serverAddress, RequestHandler)
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--mode', choices=['serial', 'threads', 'asyncio'],
+						default='serial',
+						help='serial handles one request at a time')
+	parser.add_argument('--workers', type=int, default=8)
+	parser.add_argument('--backlog', type=int, default=64,
+						help='connections the OS may hold before accept()')
+	parser.add_argument('--queue', type=int, default=64,
+						help='accepted connections waiting for a worker')
+	parser.add_argument('--idle-timeout', type=float, default=15.0,
+						help='seconds a kept-alive connection may sit idle')
+	parser.add_argument('--max-requests', type=int, default=100,
+						help='requests answered per connection before closing it')
+	parser.add_argument('--cgi-workers', type=int, default=0,
+						help='persistent CGI processes (0 starts one per request)')
+	parser.add_argument('--cgi-timeout', type=float, default=30.0,
+						help='seconds a CGI script may run')
+	parser.add_argument('--route-ttl', type=float, default=0,
+						help='seconds to reuse a path\'s resolved case (0 disables)')
+	options = parser.parse_args(argv)
+	if options.cgi_workers < 0:
+		parser.error('--cgi-workers must not be negative')
+	if min(options.workers, options.backlog, options.queue, options.max_requests) < 1:
+		parser.error('--workers, --backlog, --queue and --max-requests must be positive')
+	return options
 
 if __name__ == '__main__':
-	serverAddress = ('', 8080) # run on the current machine with port 8080
-	server = http.server.HTTPServer(serverAddress, RequestHandler)
-	server.serve_forever()
+	server = make_server(parse_args(sys.argv[1:])) # run on the current machine, port 8080 by default
+	try:
+		if isinstance(server, AsyncHTTPServer):
+			asyncio.run(server.serve_forever()) # handles SIGINT/SIGTERM itself
+		else:
+			# shutdown() waits for serve_forever() to return, so it cannot be
+			# called from the signal handler running on the serving thread.
+			signal.signal(signal.SIGTERM,
+						  lambda signum, frame: threading.Thread(target=server.shutdown).start())
+			try:
+				server.serve_forever()
+			except KeyboardInterrupt:
+				pass
+			finally:
+				server.server_close() # drains in-flight requests in threads mode
+	finally:
+		if RequestHandler.Cgi_Pool is not None:
+			RequestHandler.Cgi_Pool.close()
 
 	'''
 	a browser requesting http://localhost:8080 sends a GET request for the server and
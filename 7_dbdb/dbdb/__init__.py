@@ -1,9 +1,41 @@
 import os
 
-def connect(dbname):
+from dbdb.aio import AsyncDBDB
+from dbdb.binary_tree import BinaryTree
+from dbdb.bplus_tree import BPlusTree
+from dbdb.interface import DBDB, Snapshot
+from dbdb.sharded import ShardedDBDB
+from dbdb.storage import SnapshotStorage
+
+__all__ = [
+	'DBDB', 'Snapshot', 'AsyncDBDB', 'ShardedDBDB', 'BinaryTree', 'BPlusTree',
+	'connect', 'snapshot', 'bulk_load']
+
+def connect(dbname, **options):
 	try:
 		f = open(dbname, 'r+b')
 	except IOError:
-		fd = os.open(dbname, os.O_RDWR | os.O_CREAT)
-		f = os.fdopen(fd, 'r+b')
-	return DBDB(f)
\ No newline at end of file
+		os.close(os.open(dbname, os.O_RDWR | os.O_CREAT))
+		f = open(dbname, 'r+b')
+	return DBDB(f, **options)
+
+def snapshot(dbname, use_mmap=False, **options):
+	'''
+	Open a read-only Snapshot of dbname's last committed state without ever
+	taking the file lock, so any number of reader processes can run
+	alongside a writer.
+	'''
+	return Snapshot(SnapshotStorage.open(dbname, use_mmap), **options)
+
+def bulk_load(dbname, items, **options):
+	'''
+	Replace the contents of dbname with items, an iterable of (key, value)
+	pairs in strictly increasing key order. The input is streamed and the
+	balanced tree is written bottom-up, each node once, with one commit at
+	the end. Returns the number of keys loaded.
+	'''
+	db = connect(dbname, **options)
+	try:
+		return db.bulk_load(items)
+	finally:
+		db.close()
@@ -0,0 +1,218 @@
+import asyncio
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import dbdb
+from dbdb.cache import NodeCache
+from dbdb.interface import DBDB
+
+_MISSING = object()
+_DELETED = object()
+
+class AsyncDBDB(object):
+	'''
+	asyncio front-end to one database file. Writes and commits run in order
+	on a single writer thread, so lock waits and flushes never block the
+	event loop. Reads run on a bounded pool of reader threads against a
+	shared Snapshot of the last commit, overlaid with this handle's
+	uncommitted writes, so they never queue behind the writer. Concurrent
+	gets of one key share a single lookup.
+	'''
+
+	DEFAULT_WORKERS = 4
+	ITEMS_CHUNK = 256
+
+	def __init__(self, dbname, max_workers=DEFAULT_WORKERS, **options):
+		self._dbname = dbname
+		# Opened on the writer thread when first needed: connecting takes
+		# the file lock, which must never be waited for on the event loop.
+		self._db = None
+		self._connect_options = dict(options)
+		cache_size = options.pop('cache_size', DBDB.DEFAULT_CACHE_SIZE)
+		self._cache = NodeCache(cache_size) if cache_size else None
+		self._snapshot_options = options
+		self._writer = ThreadPoolExecutor(max_workers=1)
+		self._readers = ThreadPoolExecutor(max_workers=max_workers)
+		# Writes that have happened on the writer handle but are not yet in
+		# the committed root readers see; _DELETED marks deletions.
+		self._pending = {}
+		self._lookups = {}
+		self._snapshot = None
+		self._snapshot_inode = None
+		self._snapshot_users = {}
+		self._snapshot_lock = threading.Lock()
+		self._closed = False
+
+	async def get(self, key):
+		self._assert_not_closed()
+		value = self._pending.get(key, _MISSING)
+		if value is _DELETED:
+			raise KeyError(key)
+		if value is not _MISSING:
+			return value
+		future = self._lookups.get(key)
+		if future is None:
+			future = asyncio.get_running_loop().run_in_executor(
+				self._readers, self._read, key)
+			self._lookups[key] = future
+			future.add_done_callback(
+				lambda future: self._forget_lookup(key, future))
+		# One cancelled waiter must not cancel the lookup for the others.
+		return await asyncio.shield(future)
+
+	async def set(self, key, value):
+		self._assert_not_closed()
+		await self._write(lambda: self._pending.__setitem__(key, value),
+			'__setitem__', key, value)
+
+	async def delete(self, key):
+		self._assert_not_closed()
+		await self._write(lambda: self._pending.__setitem__(key, _DELETED),
+			'__delitem__', key)
+
+	async def commit(self):
+		self._assert_not_closed()
+		await self._write(self._committed, 'commit')
+
+	async def items(self, start=None, stop=None, reverse=False):
+		'''
+		Yield (key, value) pairs in key order. Stored items are fetched from
+		one snapshot in chunks on the reader pool and merged with the writes
+		pending when iteration started.
+		'''
+		self._assert_not_closed()
+		loop = asyncio.get_running_loop()
+		overlay = iter(sorted(
+			((key, value) for key, value in self._pending.items()
+			 if (start is None or not key < start) and (stop is None or key < stop)),
+			reverse=reverse))
+		snapshot = await loop.run_in_executor(self._readers, self._acquire_snapshot)
+		try:
+			stored = await loop.run_in_executor(
+				self._readers, snapshot.items, start, stop, reverse)
+			written = next(overlay, None)
+			while True:
+				chunk = await loop.run_in_executor(
+					self._readers, list, itertools.islice(stored, self.ITEMS_CHUNK))
+				for key, value in chunk:
+					while written is not None and (
+							written[0] > key if reverse else written[0] < key):
+						if written[1] is not _DELETED:
+							yield written
+						written = next(overlay, None)
+					if written is not None and written[0] == key:
+						if written[1] is not _DELETED:
+							yield written
+						written = next(overlay, None)
+					else:
+						yield key, value
+				if len(chunk) < self.ITEMS_CHUNK:
+					break
+			while written is not None:
+				if written[1] is not _DELETED:
+					yield written
+				written = next(overlay, None)
+		finally:
+			self._release_snapshot(snapshot)
+
+	async def close(self):
+		'''
+		Wait for queued writes to finish, then close the database. Writes
+		that were never committed are discarded, as with DBDB.close().
+		'''
+		if self._closed:
+			return
+		self._closed = True
+		await asyncio.get_running_loop().run_in_executor(None, self._shutdown)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+	async def _write(self, applied, method, *args):
+		future = asyncio.get_running_loop().run_in_executor(
+			self._writer, self._call_writer, method, *args)
+		# The overlay is updated from the future rather than after the await,
+		# so a cancelled caller cannot leave a finished write invisible.
+		# Writer futures complete in submission order, and so do these
+		# callbacks.
+		future.add_done_callback(
+			lambda future: future.cancelled() or future.exception() or applied())
+		await asyncio.shield(future)
+
+	def _connect(self):
+		# Runs on the writer thread only.
+		if self._db is None:
+			self._db = dbdb.connect(self._dbname, **self._connect_options)
+		return self._db
+
+	def _call_writer(self, method, *args):
+		return getattr(self._connect(), method)(*args)
+
+	def _committed(self):
+		self._pending.clear()
+		self._lookups.clear()
+
+	def _forget_lookup(self, key, future):
+		if self._lookups.get(key) is future:
+			del self._lookups[key]
+		if not future.cancelled():
+			future.exception()
+
+	def _read(self, key):
+		snapshot = self._acquire_snapshot()
+		try:
+			return snapshot[key]
+		finally:
+			self._release_snapshot(snapshot)
+
+	def _acquire_snapshot(self):
+		# Runs on reader threads. The writer's own Storage is never touched
+		# here; a snapshot is replaced once its file has moved on.
+		with self._snapshot_lock:
+			snapshot = self._snapshot
+			if snapshot is None or snapshot.stale():
+				if self._db is None:
+					# A new file only exists once the writer has connected.
+					self._writer.submit(self._connect).result()
+				inode = os.stat(self._dbname).st_ino
+				if inode != self._snapshot_inode and self._cache is not None:
+					# Compaction replaced the file, so cached addresses are
+					# meaningless now.
+					self._cache.clear()
+				self._snapshot_inode = inode
+				snapshot = dbdb.snapshot(
+					self._dbname, node_cache=self._cache, **self._snapshot_options)
+				if self._snapshot is not None and not self._snapshot_users[self._snapshot]:
+					del self._snapshot_users[self._snapshot]
+					self._snapshot.close()
+				self._snapshot = snapshot
+				self._snapshot_users[snapshot] = 0
+			self._snapshot_users[snapshot] += 1
+			return snapshot
+
+	def _release_snapshot(self, snapshot):
+		with self._snapshot_lock:
+			self._snapshot_users[snapshot] -= 1
+			if not self._snapshot_users[snapshot] and snapshot is not self._snapshot:
+				del self._snapshot_users[snapshot]
+				snapshot.close()
+
+	def _shutdown(self):
+		self._readers.shutdown(wait=True)
+		self._writer.shutdown(wait=True)
+		with self._snapshot_lock:
+			for snapshot in self._snapshot_users:
+				snapshot.close()
+			self._snapshot_users.clear()
+			self._snapshot = None
+		if self._db is not None:
+			self._db.close()
+
+	def _assert_not_closed(self):
+		if self._closed:
+			raise ValueError('Database closed.')
@@ -0,0 +1,264 @@
+'''
+Benchmarks for dbdb operations and file growth.
+
+	python -m dbdb.bench [--size N] [--tree binary|bplus] [WORKLOAD ...]
+
+Each workload prints one JSON object per line with throughput, p50/p99
+latency, bytes appended per logical write and the final file size, so
+runs can be diffed or appended to a history file across releases.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import dbdb
+
+TREES = {'binary': dbdb.BinaryTree, 'bplus': dbdb.BPlusTree}
+
+def percentile(samples, fraction):
+	if not samples:
+		return None
+	ordered = sorted(samples)
+	return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def report(name, options, latencies, elapsed, writes=0, grown=0, path=None, **extra):
+	result = {
+		'workload': name,
+		'size': options.size,
+		'tree': options.tree,
+		'ops': len(latencies),
+		'seconds': elapsed,
+		'ops_per_second': len(latencies) / elapsed if elapsed else None,
+		'p50_ms': _ms(percentile(latencies, 0.50)),
+		'p99_ms': _ms(percentile(latencies, 0.99)),
+		'bytes_per_write': grown / writes if writes else None,
+		'file_size': os.path.getsize(path) if path else None,
+		'python': platform.python_version(),
+	}
+	result.update(extra)
+	return result
+
+def _ms(seconds):
+	return None if seconds is None else seconds * 1000.0
+
+def connect(options, path, **overrides):
+	kwargs = {'tree_class': TREES[options.tree], 'use_mmap': options.mmap}
+	if options.tree == 'bplus':
+		kwargs['fanout'] = options.fanout
+	kwargs.update(overrides)
+	return dbdb.connect(path, **kwargs)
+
+def key_for(i):
+	return 'key{0:010d}'.format(i)
+
+def value_for(options, i):
+	return str(i).rjust(options.value_size, 'v')
+
+def load(options, path, order):
+	db = connect(options, path)
+	start_size = os.path.getsize(path)
+	latencies = []
+	started = time.perf_counter()
+	for n, i in enumerate(order, 1):
+		t = time.perf_counter()
+		db[key_for(i)] = value_for(options, i)
+		if n % options.commit_every == 0 or n == len(order):
+			db.commit()
+		latencies.append(time.perf_counter() - t)
+	elapsed = time.perf_counter() - started
+	db.close()
+	return latencies, elapsed, os.path.getsize(path) - start_size
+
+def bench_random_set(options, path):
+	order = list(range(options.size))
+	random.Random(options.seed).shuffle(order)
+	latencies, elapsed, grown = load(options, path, order)
+	return report('random_set', options, latencies, elapsed,
+		len(order), grown, path, commit_every=options.commit_every)
+
+def bench_sequential_set(options, path):
+	order = list(range(options.size))
+	latencies, elapsed, grown = load(options, path, order)
+	return report('sequential_set', options, latencies, elapsed,
+		len(order), grown, path, commit_every=options.commit_every)
+
+def populated(options, path):
+	if not os.path.exists(path) or os.path.getsize(path) <= 4096:
+		dbdb.bulk_load(path,
+			((key_for(i), value_for(options, i)) for i in range(options.size)),
+			**_tree_kwargs(options))
+	return path
+
+def _tree_kwargs(options):
+	kwargs = {'tree_class': TREES[options.tree]}
+	if options.tree == 'bplus':
+		kwargs['fanout'] = options.fanout
+	return kwargs
+
+def bench_cold_get(options, path):
+	# Every lookup goes through a fresh handle with no node cache. The OS
+	# page cache is not dropped, so this measures parse and seek cost.
+	populated(options, path)
+	keys = _lookup_keys(options)
+	latencies = []
+	started = time.perf_counter()
+	for key in keys:
+		t = time.perf_counter()
+		db = connect(options, path, cache_size=0)
+		db[key]
+		db.close()
+		latencies.append(time.perf_counter() - t)
+	return report('cold_get', options, latencies,
+		time.perf_counter() - started, path=path)
+
+def bench_warm_get(options, path):
+	populated(options, path)
+	keys = _lookup_keys(options)
+	db = connect(options, path, cache_size=options.cache_size)
+	for key in keys:
+		db[key]
+	latencies = []
+	started = time.perf_counter()
+	for key in keys:
+		t = time.perf_counter()
+		db[key]
+		latencies.append(time.perf_counter() - t)
+	elapsed = time.perf_counter() - started
+	info = db.cache_info()
+	db.close()
+	return report('warm_get', options, latencies, elapsed, path=path, cache=info)
+
+def _lookup_keys(options):
+	rnd = random.Random(options.seed)
+	return [key_for(rnd.randrange(options.size)) for _ in range(options.lookups)]
+
+def _mixed_worker(options, path, worker, queue):
+	rnd = random.Random(options.seed + worker)
+	db = connect(options, path)
+	latencies = []
+	writes = 0
+	deadline = time.perf_counter() + options.duration
+	while time.perf_counter() < deadline:
+		key = key_for(rnd.randrange(options.size))
+		t = time.perf_counter()
+		if rnd.random() < options.write_ratio:
+			db[key] = value_for(options, worker)
+			db.commit()
+			writes += 1
+		else:
+			db[key]
+		latencies.append(time.perf_counter() - t)
+	db.close()
+	queue.put((latencies, writes))
+
+def bench_mixed(options, path):
+	populated(options, path)
+	start_size = os.path.getsize(path)
+	queue = multiprocessing.Queue()
+	workers = [
+		multiprocessing.Process(
+			target=_mixed_worker, args=(options, path, worker, queue))
+		for worker in range(options.processes)]
+	started = time.perf_counter()
+	for worker in workers:
+		worker.start()
+	latencies, writes = [], 0
+	for _ in workers:
+		worker_latencies, worker_writes = queue.get()
+		latencies.extend(worker_latencies)
+		writes += worker_writes
+	for worker in workers:
+		worker.join()
+	elapsed = time.perf_counter() - started
+	return report('mixed', options, latencies, elapsed, writes,
+		os.path.getsize(path) - start_size, path,
+		processes=options.processes, write_ratio=options.write_ratio)
+
+def bench_tool(options, path):
+	populated(options, path)
+	env = dict(os.environ)
+	package_root = os.path.dirname(os.path.dirname(os.path.abspath(dbdb.__file__)))
+	env['PYTHONPATH'] = os.pathsep.join(
+		[package_root] + [p for p in [env.get('PYTHONPATH')] if p])
+	latencies = []
+	started = time.perf_counter()
+	for i in range(options.tool_runs):
+		t = time.perf_counter()
+		subprocess.check_call(
+			[sys.executable, '-m', 'dbdb.tool', path, 'get', key_for(i % options.size)],
+			stdout=subprocess.DEVNULL, env=env)
+		latencies.append(time.perf_counter() - t)
+	return report('tool', options, latencies,
+		time.perf_counter() - started, path=path)
+
+WORKLOADS = {
+	'random_set': bench_random_set,
+	'sequential_set': bench_sequential_set,
+	'cold_get': bench_cold_get,
+	'warm_get': bench_warm_get,
+	'mixed': bench_mixed,
+	'tool': bench_tool,
+}
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(prog='python -m dbdb.bench')
+	parser.add_argument('workloads', nargs='*', metavar='WORKLOAD',
+		help='one of {0} (default: all)'.format(', '.join(sorted(WORKLOADS))))
+	parser.add_argument('--size', type=int, default=10000)
+	parser.add_argument('--tree', choices=sorted(TREES), default='binary')
+	parser.add_argument('--fanout', type=int, default=dbdb.BPlusTree.DEFAULT_FANOUT)
+	parser.add_argument('--mmap', action='store_true')
+	parser.add_argument('--value-size', type=int, default=32)
+	parser.add_argument('--commit-every', type=int, default=1)
+	parser.add_argument('--lookups', type=int, default=2000)
+	parser.add_argument('--cache-size', type=int, default=dbdb.DBDB.DEFAULT_CACHE_SIZE)
+	parser.add_argument('--processes', type=int, default=4)
+	parser.add_argument('--write-ratio', type=float, default=0.1)
+	parser.add_argument('--duration', type=float, default=5.0)
+	parser.add_argument('--tool-runs', type=int, default=20)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--dir', help='scratch directory (default: a temp dir)')
+	options = parser.parse_args(argv)
+	for name in options.workloads:
+		if name not in WORKLOADS:
+			parser.error('unknown workload {0!r}'.format(name))
+	return options
+
+def main(argv):
+	options = parse_args(argv[1:])
+	workdir = options.dir or tempfile.mkdtemp(prefix='dbdb-bench-')
+	try:
+		for name in options.workloads or sorted(WORKLOADS):
+			# Write workloads start from an empty file; read workloads share
+			# one bulk-loaded file.
+			if name.endswith('_set'):
+				path = os.path.join(workdir, name + '.db')
+				if os.path.exists(path):
+					os.remove(path)
+			else:
+				path = os.path.join(workdir, 'read.db')
+			try:
+				result = WORKLOADS[name](options, path)
+			except Exception as e:
+				# e.g. sequential keys drive BinaryTree past the recursion
+				# limit; that is a result worth recording, not a crash.
+				result = {'workload': name, 'size': options.size,
+					'tree': options.tree, 'error': repr(e)}
+			if result is not None:
+				print(json.dumps(result, sort_keys=True))
+				sys.stdout.flush()
+	finally:
+		if options.dir is None:
+			shutil.rmtree(workdir)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
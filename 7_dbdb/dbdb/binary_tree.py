@@ -1,5 +1,33 @@
+import bisect
+import pickle
+import struct
+
+from dbdb import encoding
+from dbdb.logical import VALUE_REF_CLASSES, ExtentValueRef, LogicalBase, ValueRef
+
+# format, flags, left, value, right, length, key length; then the key.
+NODE_FORMAT = 1
+NODE_HEADER = struct.Struct('!BBQQQQI')
+NODE_VALUE_EXTENT = 0x02
+
 class BinaryNode(object):
 
+	@classmethod
+	def from_node(cls, node, **kwargs):
+		return cls(
+			left_ref = kwargs.get('left_ref', node.left_ref),
+			key = kwargs.get('key', node.key),
+			value_ref = kwargs.get('value_ref', node.value_ref),
+			right_ref = kwargs.get('right_ref', node.right_ref),
+			length = kwargs.get('length', node.length))
+
+	def __init__(self, left_ref, key, value_ref, right_ref, length):
+		self.left_ref = left_ref
+		self.key = key
+		self.value_ref = value_ref
+		self.right_ref = right_ref
+		self.length = length
+
 	def store_refs(self, storage):
 		self.value_ref.store(storage)
 		self.left_ref.store(storage)
@@ -7,22 +35,68 @@ class BinaryNode(object):
 
 class BinaryNodeRef(ValueRef):
 
-	@staticmethod
-	def referent_to_string(referent):
-		return pickle.dumps({
-			'left': referent.left_ref.address,
-			'key': referent.key,
-			'value': referent.value_ref.address,
-			'right': referent.right_ref.address,
-			'length': referent.length	
-		})
-
 	def prepare_to_store(self, storage):
 		if self._referent:
 			self._referent.store_refs(storage)
 
+	@staticmethod
+	def is_node(string):
+		if encoding.is_pickled(string):
+			return 'left' in pickle.loads(string)
+		return string[0] == NODE_FORMAT
+
+	@staticmethod
+	def referent_to_string(referent):
+		flags, key = encoding.encode_key(referent.key)
+		if referent.value_ref.KIND == ExtentValueRef.KIND:
+			flags |= NODE_VALUE_EXTENT
+		return NODE_HEADER.pack(
+			NODE_FORMAT,
+			flags,
+			referent.left_ref.address,
+			referent.value_ref.address,
+			referent.right_ref.address,
+			referent.length,
+			len(key)) + key
+
+	@staticmethod
+	def string_to_referent(string):
+		value_ref_class = ValueRef
+		if encoding.is_pickled(string):
+			d = pickle.loads(string)
+			left, key, value, right, length = (
+				d['left'], d['key'], d['value'], d['right'], d['length'])
+		else:
+			encoding.check_format(string, NODE_FORMAT)
+			_, flags, left, value, right, length, key_length = \
+				NODE_HEADER.unpack_from(string)
+			key = encoding.decode_key(
+				string[NODE_HEADER.size:NODE_HEADER.size + key_length], flags)
+			if flags & NODE_VALUE_EXTENT:
+				value_ref_class = ExtentValueRef
+		return BinaryNode(
+			BinaryNodeRef(address = left),
+			key,
+			value_ref_class(address = value),
+			BinaryNodeRef(address = right),
+			length)
+
+	def copy_to(self, storage, destination):
+		if not self._address:
+			return 0
+		node = self.string_to_referent(storage.read(self._address))
+		return destination.write(self.referent_to_string(BinaryNode(
+			BinaryNodeRef(address = node.left_ref.copy_to(storage, destination)),
+			node.key,
+			VALUE_REF_CLASSES[node.value_ref.KIND](
+				address = node.value_ref.copy_to(storage, destination)),
+			BinaryNodeRef(address = node.right_ref.copy_to(storage, destination)),
+			node.length)))
+
 class BinaryTree(LogicalBase):
 
+	node_ref_class = BinaryNodeRef
+
 	def _get(self, node, key):
 		while node is not None:
 			if key < node.key:
@@ -30,23 +104,193 @@ class BinaryTree(LogicalBase):
 			elif key > node.key:
 				node = self._follow(node.right_ref)
 			else:
-				return self._follow(node.value_ref)
-		raise ValueError
+				return node.value_ref
+		raise KeyError
 
 	def _insert(self, node, key, value_ref):
 		if node is None:
 			new_node = BinaryNode(
 				self.node_ref_class(), key, value_ref, self.node_ref_class(), 1)
 		elif key < node.key:
+			left = self._follow(node.left_ref)
+			left_ref = self._insert(left, key, value_ref)
 			new_node = BinaryNode.from_node(
 				node,
-				left_ref = self._insert(
-					self._follow(node.left_ref), key, value_ref))
+				left_ref = left_ref,
+				length = self._resized(node, left, left_ref))
 		elif key > node.key:
+			right = self._follow(node.right_ref)
+			right_ref = self._insert(right, key, value_ref)
 			new_node = BinaryNode.from_node(
 				node,
-				right_ref = self._insert(
-					self._follow(node.right_ref), key, value_ref))
+				right_ref = right_ref,
+				length = self._resized(node, right, right_ref))
 		else:
 			new_node = BinaryNode.from_node(node, value_ref = value_ref)
-		return self.node_ref_class(referent = new_node)
\ No newline at end of file
+		return self.node_ref_class(referent = new_node)
+
+	def _delete(self, node, key):
+		if node is None:
+			raise KeyError
+		elif key < node.key:
+			left = self._follow(node.left_ref)
+			left_ref = self._delete(left, key)
+			new_node = BinaryNode.from_node(
+				node,
+				left_ref = left_ref,
+				length = self._resized(node, left, left_ref))
+		elif key > node.key:
+			right = self._follow(node.right_ref)
+			right_ref = self._delete(right, key)
+			new_node = BinaryNode.from_node(
+				node,
+				right_ref = right_ref,
+				length = self._resized(node, right, right_ref))
+		else:
+			left = self._follow(node.left_ref)
+			right = self._follow(node.right_ref)
+			if left and right:
+				replacement = self._find_max(left)
+				left_ref = self._delete(left, replacement.key)
+				new_node = BinaryNode(
+					left_ref,
+					replacement.key,
+					replacement.value_ref,
+					node.right_ref,
+					node.length - 1)
+			elif left:
+				return node.left_ref
+			else:
+				return node.right_ref
+		return self.node_ref_class(referent = new_node)
+
+	def _insert_many(self, ref, keys, value_refs):
+		return self._insert_range(ref, keys, value_refs, 0, len(keys))[0]
+
+	def _insert_range(self, ref, keys, value_refs, lo, hi):
+		# Returns the new subtree ref and how many keys it gained. Each node
+		# on a path shared by several keys is copied once, not once per key.
+		if lo == hi:
+			return ref, 0
+		node = self._follow(ref)
+		if node is None:
+			mid = (lo + hi) // 2
+			left_ref, _ = self._insert_range(ref, keys, value_refs, lo, mid)
+			right_ref, _ = self._insert_range(ref, keys, value_refs, mid + 1, hi)
+			return self.node_ref_class(referent = BinaryNode(
+				left_ref, keys[mid], value_refs[mid], right_ref, hi - lo)), hi - lo
+		i = bisect.bisect_left(keys, node.key, lo, hi)
+		found = i < hi and keys[i] == node.key
+		left_ref, left_added = self._insert_range(
+			node.left_ref, keys, value_refs, lo, i)
+		right_ref, right_added = self._insert_range(
+			node.right_ref, keys, value_refs, i + 1 if found else i, hi)
+		new_node = BinaryNode.from_node(
+			node,
+			left_ref = left_ref,
+			value_ref = value_refs[i] if found else node.value_ref,
+			right_ref = right_ref,
+			length = node.length + left_added + right_added)
+		return self.node_ref_class(referent = new_node), left_added + right_added
+
+	def _delete_many(self, ref, keys):
+		return self._delete_range(ref, keys, 0, len(keys))
+
+	def _delete_range(self, ref, keys, lo, hi):
+		if lo == hi:
+			return ref, 0
+		node = self._follow(ref)
+		if node is None:
+			return ref, 0
+		i = bisect.bisect_left(keys, node.key, lo, hi)
+		found = i < hi and keys[i] == node.key
+		left_ref, left_removed = self._delete_range(node.left_ref, keys, lo, i)
+		right_ref, right_removed = self._delete_range(
+			node.right_ref, keys, i + 1 if found else i, hi)
+		removed = left_removed + right_removed + found
+		if not found:
+			new_node = BinaryNode.from_node(
+				node,
+				left_ref = left_ref,
+				right_ref = right_ref,
+				length = node.length - removed)
+			return self.node_ref_class(referent = new_node), removed
+		left = self._follow(left_ref)
+		if left is None:
+			return right_ref, removed
+		if self._follow(right_ref) is None:
+			return left_ref, removed
+		replacement = self._find_max(left)
+		new_node = BinaryNode(
+			self._delete(left, replacement.key),
+			replacement.key,
+			replacement.value_ref,
+			right_ref,
+			node.length - removed)
+		return self.node_ref_class(referent = new_node), removed
+
+	def _resized(self, node, old_child, new_child_ref):
+		# Child refs read through the node cache do not keep their referent,
+		# so lengths come from the nodes that were actually followed.
+		old_length = old_child.length if old_child else 0
+		new_child = self._follow(new_child_ref)
+		new_length = new_child.length if new_child else 0
+		return node.length + new_length - old_length
+
+	def _iter(self, node, start, stop, reverse):
+		if reverse:
+			near, far = 'right_ref', 'left_ref'
+			skip = lambda key: stop is not None and not key < stop
+			done = lambda key: start is not None and key < start
+		else:
+			near, far = 'left_ref', 'right_ref'
+			skip = lambda key: start is not None and key < start
+			done = lambda key: stop is not None and not key < stop
+		stack = []
+		while stack or node is not None:
+			if node is not None:
+				if skip(node.key):
+					node = self._follow(getattr(node, far))
+				else:
+					stack.append(node)
+					node = self._follow(getattr(node, near))
+			else:
+				node = stack.pop()
+				if done(node.key):
+					return
+				yield node.key, node.value_ref
+				node = self._follow(getattr(node, far))
+
+	def _build(self, entries):
+		# Binary counter: a pending root waits for a right subtree as tall as
+		# its left one, so the finished tree is at most one level taller
+		# than a perfectly balanced one. Subtrees are (address, length, height).
+		empty = (0, 0, 0)
+		pending = []
+		for key, value_ref in entries:
+			subtree = empty
+			while pending and pending[-1][2][2] == subtree[2]:
+				subtree = self._write_built(pending.pop(), subtree)
+			pending.append((key, value_ref, subtree))
+		subtree = empty
+		while pending:
+			subtree = self._write_built(pending.pop(), subtree)
+		return subtree[0]
+
+	def _write_built(self, root, right):
+		key, value_ref, left = root
+		node = BinaryNode(
+			BinaryNodeRef(address = left[0]),
+			key,
+			value_ref,
+			BinaryNodeRef(address = right[0]),
+			left[1] + right[1] + 1)
+		address = self._storage.write(self.node_ref_class.referent_to_string(node))
+		return address, node.length, max(left[2], right[2]) + 1
+
+	def _find_max(self, node):
+		while True:
+			next_node = self._follow(node.right_ref)
+			if next_node is None:
+				return node
+			node = next_node
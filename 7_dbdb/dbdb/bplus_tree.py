@@ -0,0 +1,431 @@
+import bisect
+import pickle
+import struct
+
+from dbdb import encoding
+from dbdb.logical import VALUE_REF_CLASSES, LogicalBase, ValueRef
+
+# format, flags, ref count; then the ref addresses, the per-child counts of
+# internal nodes or, for leaves holding extents, one kind byte per value,
+# and the length-prefixed keys.
+NODE_FORMAT = 2
+NODE_HEADER = struct.Struct('!BBH')
+NODE_LEAF = 0x80
+NODE_VALUE_KINDS = 0x40
+
+class BPlusNode(object):
+	'''
+	Leaf nodes hold sorted keys with one value ref per key. Internal nodes
+	hold len(refs) - 1 separator keys, where keys[i] is the smallest key
+	reachable through refs[i + 1], plus the number of keys under each child.
+	'''
+
+	def __init__(self, keys, refs, counts=None):
+		self.keys = tuple(keys)
+		self.refs = tuple(refs)
+		self.counts = None if counts is None else tuple(counts)
+
+	@property
+	def is_leaf(self):
+		return self.counts is None
+
+	@property
+	def length(self):
+		if self.is_leaf:
+			return len(self.keys)
+		return sum(self.counts)
+
+	def store_refs(self, storage):
+		for ref in self.refs:
+			ref.store(storage)
+
+class BPlusNodeRef(ValueRef):
+
+	def prepare_to_store(self, storage):
+		if self._referent:
+			self._referent.store_refs(storage)
+
+	@staticmethod
+	def is_node(string):
+		if encoding.is_pickled(string):
+			return 'refs' in pickle.loads(string)
+		return string[0] == NODE_FORMAT
+
+	@staticmethod
+	def referent_to_string(referent):
+		flags, keys = encoding.pack_keys(referent.keys)
+		kinds = b''
+		if referent.is_leaf:
+			flags |= NODE_LEAF
+			integers = [ref.address for ref in referent.refs]
+			if any(ref.KIND for ref in referent.refs):
+				flags |= NODE_VALUE_KINDS
+				kinds = bytes(ref.KIND for ref in referent.refs)
+		else:
+			integers = [ref.address for ref in referent.refs] + list(referent.counts)
+		return b''.join([
+			NODE_HEADER.pack(NODE_FORMAT, flags, len(referent.refs)),
+			struct.pack('!{0}Q'.format(len(integers)), *integers),
+			kinds,
+			keys])
+
+	@staticmethod
+	def string_to_referent(string):
+		kinds = None
+		if encoding.is_pickled(string):
+			d = pickle.loads(string)
+			keys, addresses, counts = d['keys'], d['refs'], d['counts']
+		else:
+			encoding.check_format(string, NODE_FORMAT)
+			_, flags, ref_count = NODE_HEADER.unpack_from(string)
+			integer_count = ref_count if flags & NODE_LEAF else 2 * ref_count
+			integers = struct.unpack_from(
+				'!{0}Q'.format(integer_count), string, NODE_HEADER.size)
+			addresses = integers[:ref_count]
+			counts = None if flags & NODE_LEAF else integers[ref_count:]
+			key_count = ref_count if flags & NODE_LEAF else ref_count - 1
+			offset = NODE_HEADER.size + 8 * integer_count
+			if flags & NODE_VALUE_KINDS:
+				kinds = string[offset:offset + ref_count]
+				offset += ref_count
+			keys = encoding.unpack_keys(string, offset, key_count, flags)
+		if kinds is not None:
+			refs = [VALUE_REF_CLASSES[kind](address = address)
+					for kind, address in zip(kinds, addresses)]
+		elif counts is None:
+			refs = [ValueRef(address = address) for address in addresses]
+		else:
+			refs = [BPlusNodeRef(address = address) for address in addresses]
+		return BPlusNode(keys, refs, counts)
+
+	def copy_to(self, storage, destination):
+		if not self._address:
+			return 0
+		node = self.string_to_referent(storage.read(self._address))
+		refs = [type(ref)(address = ref.copy_to(storage, destination))
+				for ref in node.refs]
+		return destination.write(self.referent_to_string(
+			BPlusNode(node.keys, refs, node.counts)))
+
+class BPlusTree(LogicalBase):
+
+	node_ref_class = BPlusNodeRef
+	DEFAULT_FANOUT = 128
+
+	def __init__(self, storage, fanout=DEFAULT_FANOUT, **options):
+		if fanout < 4:
+			raise ValueError('B+tree fanout must be at least 4')
+		self.fanout = fanout
+		super().__init__(storage, **options)
+
+	def _get(self, node, key):
+		while node is not None:
+			if node.is_leaf:
+				i = bisect.bisect_left(node.keys, key)
+				if i < len(node.keys) and node.keys[i] == key:
+					return node.refs[i]
+				break
+			node = self._follow(node.refs[bisect.bisect_right(node.keys, key)])
+		raise KeyError
+
+	def _iter(self, node, start, stop, reverse):
+		# Leaves are not linked, so the path down to the current leaf is kept
+		# and walked back up to reach the next one. Every descent applies the
+		# bounds, which only narrows the first path taken.
+		path = []
+		while node is not None:
+			if node.is_leaf:
+				if reverse:
+					end = len(node.keys) if stop is None else \
+						bisect.bisect_left(node.keys, stop)
+					indexes = range(end - 1, -1, -1)
+				else:
+					begin = 0 if start is None else bisect.bisect_left(node.keys, start)
+					indexes = range(begin, len(node.keys))
+				for i in indexes:
+					key = node.keys[i]
+					if reverse and start is not None and key < start:
+						return
+					if not reverse and stop is not None and not key < stop:
+						return
+					yield key, node.refs[i]
+				node = None
+				while path and node is None:
+					parent, i = path.pop()
+					i += -1 if reverse else 1
+					if 0 <= i < len(parent.refs):
+						path.append((parent, i))
+						node = self._follow(parent.refs[i])
+			else:
+				if reverse:
+					i = len(node.keys) if stop is None else \
+						bisect.bisect_left(node.keys, stop)
+				else:
+					i = 0 if start is None else bisect.bisect_right(node.keys, start)
+				path.append((node, i))
+				node = self._follow(node.refs[i])
+
+	def _build(self, entries):
+		# levels[0] holds (key, stored value ref) pairs, higher levels hold
+		# (first key, node address, key count) for finished children. A level
+		# only emits a full node once enough entries are queued behind it to
+		# keep the level's last node at least half full.
+		minimum = self.fanout // 2
+		levels = [[]]
+		for key, value_ref in entries:
+			levels[0].append((key, value_ref))
+			height = 0
+			while len(levels[height]) >= self.fanout + minimum:
+				self._emit(levels, height, self.fanout)
+				height += 1
+		height = 0
+		while True:
+			level = levels[height]
+			if height == len(levels) - 1 and len(level) <= self.fanout:
+				if not level:
+					return 0
+				if height and len(level) == 1:
+					return level[0][1]
+				return self._write_built(height, level)[1]
+			if len(level) > self.fanout:
+				self._emit(levels, height, len(level) // 2)
+			self._emit(levels, height, len(level))
+			height += 1
+
+	def _emit(self, levels, height, size):
+		if height + 1 == len(levels):
+			levels.append([])
+		levels[height + 1].append(self._write_built(height, levels[height][:size]))
+		del levels[height][:size]
+
+	def _write_built(self, height, entries):
+		if height == 0:
+			node = BPlusNode(
+				[key for key, _ in entries],
+				[value_ref for _, value_ref in entries])
+		else:
+			node = BPlusNode(
+				[key for key, _, _ in entries[1:]],
+				[BPlusNodeRef(address = address) for _, address, _ in entries],
+				[count for _, _, count in entries])
+		address = self._storage.write(self.node_ref_class.referent_to_string(node))
+		return entries[0][0], address, node.length
+
+	def _insert(self, node, key, value_ref):
+		if node is None:
+			new_node = BPlusNode([key], [value_ref])
+		else:
+			new_node = self._grow(*self._insert_into(node, key, value_ref))
+		return self.node_ref_class(referent = new_node)
+
+	def _grow(self, pieces, separators):
+		# Stack new roots on top until the pieces fit under a single node.
+		while len(pieces) > 1:
+			pieces, separators = self._split(BPlusNode(
+				separators,
+				[self.node_ref_class(referent = piece) for piece in pieces],
+				[piece.length for piece in pieces]))
+		return pieces[0]
+
+	def _insert_into(self, node, key, value_ref):
+		keys, refs = list(node.keys), list(node.refs)
+		if node.is_leaf:
+			i = bisect.bisect_left(keys, key)
+			if i < len(keys) and keys[i] == key:
+				refs[i] = value_ref
+			else:
+				keys.insert(i, key)
+				refs.insert(i, value_ref)
+			return self._split(BPlusNode(keys, refs))
+
+		counts = list(node.counts)
+		i = bisect.bisect_right(keys, key)
+		pieces, separators = self._insert_into(
+			self._follow(refs[i]), key, value_ref)
+		refs[i:i + 1] = [self.node_ref_class(referent = p) for p in pieces]
+		counts[i:i + 1] = [p.length for p in pieces]
+		keys[i:i] = separators
+		return self._split(BPlusNode(keys, refs, counts))
+
+	def _split(self, node):
+		count = len(node.refs)
+		if count <= self.fanout:
+			return [node], []
+		parts = -(-count // self.fanout)
+		bounds = [count * i // parts for i in range(parts + 1)]
+		pieces, separators = [], []
+		for lo, hi in zip(bounds, bounds[1:]):
+			if node.is_leaf:
+				pieces.append(BPlusNode(node.keys[lo:hi], node.refs[lo:hi]))
+				if lo:
+					separators.append(node.keys[lo])
+			else:
+				pieces.append(BPlusNode(
+					node.keys[lo:hi - 1], node.refs[lo:hi], node.counts[lo:hi]))
+				if lo:
+					separators.append(node.keys[lo - 1])
+		return pieces, separators
+
+	def _insert_many(self, ref, keys, value_refs):
+		node = self._follow(ref)
+		if node is None:
+			node = BPlusNode([], [])
+		return self.node_ref_class(referent = self._grow(
+			*self._insert_batch(node, keys, value_refs)))
+
+	def _insert_batch(self, node, keys, value_refs):
+		if node.is_leaf:
+			old_keys, old_refs = node.keys, node.refs
+			new_keys, new_refs = [], []
+			j = 0
+			for key, value_ref in zip(keys, value_refs):
+				while j < len(old_keys) and old_keys[j] < key:
+					new_keys.append(old_keys[j])
+					new_refs.append(old_refs[j])
+					j += 1
+				if j < len(old_keys) and old_keys[j] == key:
+					j += 1
+				new_keys.append(key)
+				new_refs.append(value_ref)
+			new_keys.extend(old_keys[j:])
+			new_refs.extend(old_refs[j:])
+			return self._split(BPlusNode(new_keys, new_refs))
+
+		new_keys, new_refs, new_counts = [], [], []
+		lo = 0
+		for i, ref in enumerate(node.refs):
+			if i:
+				new_keys.append(node.keys[i - 1])
+			hi = len(keys) if i == len(node.keys) else \
+				bisect.bisect_left(keys, node.keys[i], lo)
+			if lo == hi:
+				new_refs.append(ref)
+				new_counts.append(node.counts[i])
+				continue
+			pieces, separators = self._insert_batch(
+				self._follow(ref), keys[lo:hi], value_refs[lo:hi])
+			new_keys.extend(separators)
+			new_refs.extend(self.node_ref_class(referent = p) for p in pieces)
+			new_counts.extend(p.length for p in pieces)
+			lo = hi
+		return self._split(BPlusNode(new_keys, new_refs, new_counts))
+
+	def _delete(self, node, key):
+		if node is None:
+			raise KeyError
+		return self._shrink(self._delete_from(node, key))
+
+	def _shrink(self, node):
+		ref = self.node_ref_class(referent = node)
+		while not node.is_leaf and len(node.refs) == 1:
+			ref = node.refs[0]
+			node = self._follow(ref)
+		if not node.refs:
+			return self.node_ref_class()
+		return ref
+
+	def _delete_many(self, ref, keys):
+		node = self._follow(ref)
+		if node is None or not keys:
+			return ref, 0
+		new_node, removed = self._delete_batch(node, keys)
+		return self._shrink(new_node), removed
+
+	def _delete_batch(self, node, keys):
+		if node.is_leaf:
+			doomed = set(keys)
+			kept = [i for i, key in enumerate(node.keys) if key not in doomed]
+			return BPlusNode(
+				[node.keys[i] for i in kept],
+				[node.refs[i] for i in kept]), len(node.keys) - len(kept)
+
+		# Children are [node, ref, count]. Rewritten children have a node and
+		# no ref yet; untouched ones have a ref and are never loaded, since
+		# only rewritten children can have become underfull.
+		children = []
+		removed = 0
+		lo = 0
+		for i, ref in enumerate(node.refs):
+			hi = len(keys) if i == len(node.keys) else \
+				bisect.bisect_left(keys, node.keys[i], lo)
+			if lo == hi:
+				children.append([None, ref, node.counts[i]])
+				continue
+			child, child_removed = self._delete_batch(self._follow(ref), keys[lo:hi])
+			removed += child_removed
+			children.append([child, None, child.length])
+			lo = hi
+
+		return self._rebalanced(children, list(node.keys)), removed
+
+	def _rebalanced(self, children, separators):
+		# A batch can empty a child down to a single underfull grandchild;
+		# _pool repairs those as they come to rest next to new neighbours.
+		i = 0
+		while i < len(children) and len(children) > 1:
+			child = children[i][0]
+			if child is None or len(child.refs) >= self.fanout // 2:
+				i += 1
+				continue
+			lo = i - 1 if i else i
+			left = children[lo][0] or self._follow(children[lo][1])
+			right = children[lo + 1][0] or self._follow(children[lo + 1][1])
+			pieces, new_separators = self._split(
+				self._pool(left, right, separators[lo]))
+			children[lo:lo + 2] = [[p, None, p.length] for p in pieces]
+			separators[lo:lo + 1] = new_separators
+			i = lo
+		return BPlusNode(
+			separators,
+			[ref or self.node_ref_class(referent = c) for c, ref, _ in children],
+			[count for _, _, count in children])
+
+	def _pool(self, left, right, separator):
+		node = self._join(left, right, separator)
+		if node.is_leaf:
+			return node
+		children = [[None, ref, count] for ref, count in zip(node.refs, node.counts)]
+		for i in (len(left.refs) - 1, len(left.refs)):
+			children[i][0] = self._follow(children[i][1])
+		return self._rebalanced(children, list(node.keys))
+
+	def _delete_from(self, node, key):
+		keys, refs = list(node.keys), list(node.refs)
+		if node.is_leaf:
+			i = bisect.bisect_left(keys, key)
+			if i == len(keys) or keys[i] != key:
+				raise KeyError
+			del keys[i]
+			del refs[i]
+			return BPlusNode(keys, refs)
+
+		counts = list(node.counts)
+		i = bisect.bisect_right(keys, key)
+		child = self._delete_from(self._follow(refs[i]), key)
+		if len(child.refs) >= self.fanout // 2:
+			refs[i] = self.node_ref_class(referent = child)
+			counts[i] = child.length
+			return BPlusNode(keys, refs, counts)
+
+		# Underfull child: pool it with a neighbour, then split again only if
+		# the pooled node no longer fits.
+		if i > 0:
+			lo = i - 1
+			left, right = self._follow(refs[lo]), child
+		else:
+			lo = i
+			left, right = child, self._follow(refs[i + 1])
+		pieces, separators = self._split(
+			self._join(left, right, keys[lo]))
+		refs[lo:lo + 2] = [self.node_ref_class(referent = p) for p in pieces]
+		counts[lo:lo + 2] = [p.length for p in pieces]
+		keys[lo:lo + 1] = separators
+		return BPlusNode(keys, refs, counts)
+
+	def _join(self, left, right, separator):
+		if left.is_leaf:
+			return BPlusNode(left.keys + right.keys, left.refs + right.refs)
+		return BPlusNode(
+			left.keys + (separator,) + right.keys,
+			left.refs + right.refs,
+			left.counts + right.counts)
@@ -0,0 +1,45 @@
+import threading
+from collections import OrderedDict
+
+class NodeCache(object):
+	'''
+	Address-keyed LRU of deserialized nodes. Stored addresses never change
+	their contents in the append-only file, so entries never go stale.
+	'''
+
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self._nodes = OrderedDict()
+		self._lock = threading.Lock()
+
+	def load(self, address, loader):
+		with self._lock:
+			node = self._nodes.get(address)
+			if node is not None:
+				self.hits += 1
+				self._nodes.move_to_end(address)
+				return node
+			self.misses += 1
+		node = loader()
+		with self._lock:
+			self._nodes[address] = node
+			if len(self._nodes) > self.max_size:
+				self._nodes.popitem(last=False)
+		return node
+
+	def clear(self):
+		with self._lock:
+			self._nodes.clear()
+
+	def info(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'size': len(self._nodes),
+			'max_size': self.max_size
+		}
+
+	def __len__(self):
+		return len(self._nodes)
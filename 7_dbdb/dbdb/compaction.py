@@ -0,0 +1,50 @@
+import os
+import stat
+import tempfile
+
+from dbdb.storage import Storage
+
+def compact(storage, node_ref_class, attempts=3):
+	'''
+	Copy the live tree into a fresh file and swap it in at storage.path.
+
+	The copy runs without the file lock so writers keep going. If a commit
+	lands meanwhile the copy is thrown away and retried; the last attempt
+	holds the lock throughout so compaction always finishes.
+	Returns the number of bytes reclaimed.
+	'''
+	if storage.path is None:
+		raise ValueError('Only databases backed by a named file can be compacted.')
+	for attempt in range(attempts):
+		if attempt == attempts - 1:
+			storage.lock()
+		generation = storage.generation
+		root_address = storage.get_root_address()
+		fd, temp_path = tempfile.mkstemp(
+			prefix = os.path.basename(storage.path) + '.',
+			suffix = '.compact',
+			dir = os.path.dirname(storage.path))
+		# mkstemp makes the file 0600; the swapped-in copy must keep the
+		# database's permissions or other users' readers are locked out.
+		os.chmod(temp_path, stat.S_IMODE(os.stat(storage.path).st_mode))
+		new_storage = Storage(os.fdopen(fd, 'r+b'))
+		try:
+			new_root_address = node_ref_class(address = root_address).copy_to(
+				storage, new_storage)
+			new_storage.commit_root_address(new_root_address)
+			new_storage.sync()
+			new_size = new_storage.size()
+			new_storage.close()
+			storage.lock()
+			if (storage.generation == generation
+					and storage.get_root_address() == root_address):
+				reclaimed = storage.size() - new_size
+				storage.swap_in(temp_path)
+				return reclaimed
+			storage.unlock()
+		finally:
+			if not new_storage.closed:
+				new_storage.close()
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+	raise RuntimeError('Database changed while compacting under lock.')
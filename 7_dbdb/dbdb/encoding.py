@@ -0,0 +1,47 @@
+import pickle
+import struct
+
+# Every pickle this package ever wrote starts with the PROTO opcode, which
+# no packed node format uses as its first byte.
+PICKLE_TAG = 0x80
+
+KEY_PICKLED = 0x01
+
+KEY_LENGTH = struct.Struct('!I')
+
+def is_pickled(string):
+	return string[0] == PICKLE_TAG
+
+def check_format(string, expected):
+	if string[0] != expected:
+		raise ValueError('Unknown node format {0}'.format(string[0]))
+
+def encode_key(key):
+	if isinstance(key, str):
+		return 0, key.encode('utf-8')
+	return KEY_PICKLED, pickle.dumps(key)
+
+def decode_key(data, flags):
+	if flags & KEY_PICKLED:
+		return pickle.loads(data)
+	return str(data, 'utf-8')
+
+def pack_keys(keys):
+	flags = 0
+	if not all(isinstance(key, str) for key in keys):
+		flags = KEY_PICKLED
+	parts = []
+	for key in keys:
+		data = pickle.dumps(key) if flags else key.encode('utf-8')
+		parts.append(KEY_LENGTH.pack(len(data)))
+		parts.append(data)
+	return flags, b''.join(parts)
+
+def unpack_keys(string, offset, count, flags):
+	keys = []
+	for _ in range(count):
+		length, = KEY_LENGTH.unpack_from(string, offset)
+		offset += KEY_LENGTH.size
+		keys.append(decode_key(string[offset:offset + length], flags))
+		offset += length
+	return keys
@@ -1,17 +1,273 @@
+import time
+
+from dbdb.binary_tree import BinaryTree
+from dbdb.bplus_tree import BPlusTree
+from dbdb.cache import NodeCache
+from dbdb.compaction import compact
+from dbdb.stats import Stats
+from dbdb.storage import Storage
+
+TREE_CLASSES = (BinaryTree, BPlusTree)
+
+def detect_tree_class(storage, default=BinaryTree):
+	'''
+	The tree class whose nodes storage holds, told apart by the format tag
+	of the root node, or default if nothing has been committed yet.
+	'''
+	root_address = storage.get_root_address()
+	if not root_address:
+		return default
+	string = storage.read(root_address)
+	for tree_class in TREE_CLASSES:
+		if tree_class.node_ref_class.is_node(string):
+			return tree_class
+	raise ValueError('Unknown node format {0}'.format(string[0]))
+
 class DBDB(object):
 
-	def __init__(self, f):
-		self._storage = Storage(f)
-		self._tree = BinaryTree(self._storage)
+	DEFAULT_CACHE_SIZE = 4096
+
+	def __init__(self, f, tree_class=None, cache_size=DEFAULT_CACHE_SIZE,
+			use_mmap=False, **tree_options):
+		self._storage = Storage(f, use_mmap=use_mmap)
+		if tree_class is None:
+			tree_class = detect_tree_class(self._storage)
+		self._cache = NodeCache(cache_size) if cache_size else None
+		self._tree = tree_class(
+			self._storage, node_cache=self._cache, **tree_options)
+		self._tree_options = dict(
+			tree_options, tree_class=tree_class, cache_size=cache_size)
+		self._trace = None
 
 	def __getitem__(self, key):
 		self._assert_not_closed()
-		return self._tree.get(key)
+		return self._call('get', key, self._tree.get, key)
+
+	def __setitem__(self, key, value):
+		self._assert_not_closed()
+		return self._call('set', key, self._tree.set, key, value)
+
+	def __delitem__(self, key):
+		self._assert_not_closed()
+		return self._call('delete', key, self._tree.pop, key)
+
+	def open_value(self, key):
+		'''
+		Return a binary file object over the UTF-8 bytes of key's value.
+		Values stored as extents are read back one chunk at a time.
+		'''
+		self._assert_not_closed()
+		return self._call('get', key, self._tree.open_value, key)
+
+	def set_stream(self, key, stream):
+		'''
+		Store everything read from the binary file object stream as key's
+		value without holding it in memory, chunk by chunk.
+		'''
+		self._assert_not_closed()
+		return self._call('set', key, self._tree.set_stream, key, stream)
+
+	def __contains__(self, key):
+		try:
+			self[key]
+		except KeyError:
+			return False
+		else:
+			return True
+
+	def __len__(self):
+		self._assert_not_closed()
+		return len(self._tree)
+
+	def __iter__(self):
+		return self.keys()
+
+	def keys(self, start=None, stop=None, reverse=False):
+		self._assert_not_closed()
+		return self._tree.keys(start, stop, reverse)
+
+	def items(self, start=None, stop=None, reverse=False):
+		self._assert_not_closed()
+		return self._tree.items(start, stop, reverse)
+
+	def prefix(self, prefix):
+		self._assert_not_closed()
+		return self._tree.prefix(prefix)
 
 	def commit(self):
 		self._assert_not_closed()
+		self._call('commit', None, self._tree.commit)
+
+	def update(self, items):
+		self._assert_not_closed()
+		if hasattr(items, 'keys'):
+			mapping = items
+			items = ((key, mapping[key]) for key in mapping.keys())
+		self._tree.set_many(items)
+		self._tree.commit()
+
+	def delete_many(self, keys):
+		self._assert_not_closed()
+		removed = self._tree.pop_many(keys)
 		self._tree.commit()
+		return removed
+
+	def bulk_load(self, items):
+		self._assert_not_closed()
+		return self._tree.bulk_load(items)
+
+	def compact(self):
+		self._assert_not_closed()
+		if self._storage.locked:
+			raise ValueError('Commit pending changes before compacting.')
+		reclaimed = compact(self._storage, self._tree.node_ref_class)
+		self._tree._refresh_tree_ref()
+		return reclaimed
+
+	def snapshot(self):
+		'''
+		Return a read-only Snapshot of the last committed state. It has its
+		own file descriptor and node cache and never takes the file lock.
+		'''
+		self._assert_not_closed()
+		return Snapshot(self._storage.snapshot(), **self._tree_options)
+
+	def cache_info(self):
+		if self._cache is None:
+			return None
+		return self._cache.info()
+
+	def enable_stats(self):
+		if self._storage.stats is None:
+			self._storage.stats = Stats()
+
+	def disable_stats(self):
+		self._storage.stats = None
+		self._trace = None
+
+	def stats(self):
+		'''
+		Return the I/O counters collected since stats were enabled or last
+		reset, or None if they are disabled.
+		'''
+		if self._storage.stats is None:
+			return None
+		counters = self._storage.stats.as_dict()
+		counters['cache'] = self.cache_info()
+		return counters
+
+	def reset_stats(self):
+		if self._storage.stats is not None:
+			self._storage.stats.reset()
+		if self._cache is not None:
+			self._cache.hits = self._cache.misses = 0
+
+	def set_trace(self, hook):
+		'''
+		Call hook(operation, key, seconds, counters) after every get, set,
+		delete and commit, where counters holds what that call alone cost.
+		Tracing turns stats on; set_trace(None) turns tracing back off.
+		'''
+		if hook is not None:
+			self.enable_stats()
+		self._trace = hook
+
+	def _call(self, operation, key, method, *args):
+		if self._trace is None:
+			return method(*args)
+		stats = self._storage.stats
+		before = stats.as_dict()
+		started = time.perf_counter()
+		try:
+			return method(*args)
+		finally:
+			self._trace(
+				operation, key, time.perf_counter() - started, stats.since(before))
+
+	def close(self):
+		self._storage.close()
 
 	def _assert_not_closed(self):
 		if self._storage.closed:
 			raise ValueError('Database closed.')
+
+
+class Snapshot(object):
+	'''
+	Read handle pinned to one root address. Commits made after it was taken
+	are invisible to it, and reads through it never wait on writers. A
+	single snapshot may be shared between threads.
+	'''
+
+	def __init__(self, storage, tree_class=None,
+			cache_size=DBDB.DEFAULT_CACHE_SIZE, node_cache=None, **tree_options):
+		# Snapshots of one file may share a node_cache, since addresses in
+		# it never change their contents.
+		self._storage = storage
+		if tree_class is None:
+			tree_class = detect_tree_class(storage)
+		if node_cache is None and cache_size:
+			node_cache = NodeCache(cache_size)
+		self._cache = node_cache
+		self._tree = tree_class(
+			self._storage, node_cache=self._cache, **tree_options)
+
+	@property
+	def root_address(self):
+		return self._storage.get_root_address()
+
+	def stale(self):
+		'''
+		True once a later commit or a compaction has moved the file on from
+		the state this snapshot sees.
+		'''
+		self._assert_not_closed()
+		return self._storage.stale()
+
+	def __getitem__(self, key):
+		self._assert_not_closed()
+		return self._tree.get(key)
+
+	def open_value(self, key):
+		self._assert_not_closed()
+		return self._tree.open_value(key)
+
+	def __contains__(self, key):
+		try:
+			self[key]
+		except KeyError:
+			return False
+		else:
+			return True
+
+	def __len__(self):
+		self._assert_not_closed()
+		return len(self._tree)
+
+	def __iter__(self):
+		return self.keys()
+
+	def keys(self, start=None, stop=None, reverse=False):
+		self._assert_not_closed()
+		return self._tree.keys(start, stop, reverse)
+
+	def items(self, start=None, stop=None, reverse=False):
+		self._assert_not_closed()
+		return self._tree.items(start, stop, reverse)
+
+	def prefix(self, prefix):
+		self._assert_not_closed()
+		return self._tree.prefix(prefix)
+
+	def close(self):
+		self._storage.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def _assert_not_closed(self):
+		if self._storage.closed:
+			raise ValueError('Snapshot closed.')
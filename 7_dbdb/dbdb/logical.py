@@ -1,28 +1,334 @@
+import io
+import struct
+import time
+import zlib
+
 class ValueRef(object):
 
+	KIND = 0
+
+	def __init__(self, referent=None, address=0):
+		self._referent = referent
+		self._address = address
+
+	@property
+	def address(self):
+		return self._address
+
+	def prepare_to_store(self, storage):
+		pass
+
+	@staticmethod
+	def referent_to_string(referent):
+		return referent.encode('utf-8')
+
+	@staticmethod
+	def string_to_referent(string):
+		return str(string, 'utf-8')
+
+	def get(self, storage, cache=None):
+		if self._referent is None and self._address:
+			if cache is not None:
+				# Cached referents are shared, so they are not pinned to this ref.
+				return cache.load(self._address, lambda: self._load(storage))
+			self._referent = self._load(storage)
+		return self._referent
+
+	def _load(self, storage):
+		string = storage.read(self._address)
+		if storage.stats is None:
+			return self.string_to_referent(string)
+		started = time.perf_counter()
+		referent = self.string_to_referent(string)
+		storage.stats.deserializations += 1
+		storage.stats.deserialize_seconds += time.perf_counter() - started
+		return referent
+
 	def store(self, storage):
 		if self._referent and not self._address:
 			self.prepare_to_store(storage)
 			self._address = storage.write(self.referent_to_string(self._referent))
 
+	def copy_to(self, storage, destination):
+		if not self._address:
+			return 0
+		return destination.write(storage.read(self._address))
+
+	def open(self, storage):
+		if self._referent is not None or not self._address:
+			return io.BytesIO(self.referent_to_string(self._referent or ''))
+		return io.BytesIO(bytes(storage.read(self._address)))
+
+# format, flags, total length, chunk count; then an address and raw length
+# per chunk.
+EXTENT_FORMAT = 1
+EXTENT_HEADER = struct.Struct('!BBQI')
+EXTENT_CHUNK = struct.Struct('!QI')
+EXTENT_COMPRESSED = 0x01
+
+class Extent(object):
+
+	def __init__(self, chunks, length, compressed):
+		self.chunks = chunks
+		self.length = length
+		self.compressed = compressed
+
+class ExtentValueRef(ValueRef):
+	'''
+	A value stored as a chain of separately written, optionally
+	zlib-compressed chunks plus an index record, so it can be written from
+	and read back into a stream one chunk at a time.
+	'''
+
+	KIND = 1
+	DEFAULT_CHUNK_SIZE = 1 << 20
+
+	def __init__(self, referent=None, address=0,
+			chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
+		super().__init__(referent, address)
+		self._chunk_size = chunk_size
+		self._compress = compress
+
+	@classmethod
+	def from_stream(cls, storage, stream, chunk_size=DEFAULT_CHUNK_SIZE,
+			compress=False):
+		chunks = iter(lambda: stream.read(chunk_size), b'')
+		return cls(address = storage.write(
+			cls._write_chunks(storage, chunks, compress)))
+
+	@staticmethod
+	def _write_chunks(storage, chunks, compress):
+		index = []
+		length = 0
+		for chunk in chunks:
+			length += len(chunk)
+			data = zlib.compress(chunk) if compress else chunk
+			index.append((storage.write(data), len(chunk)))
+		return ExtentValueRef._encode(Extent(index, length, compress))
+
+	@staticmethod
+	def _encode(extent):
+		return EXTENT_HEADER.pack(
+			EXTENT_FORMAT,
+			EXTENT_COMPRESSED if extent.compressed else 0,
+			extent.length,
+			len(extent.chunks)) + b''.join(
+				EXTENT_CHUNK.pack(address, length)
+				for address, length in extent.chunks)
+
+	@staticmethod
+	def _decode(string):
+		tag, flags, length, count = EXTENT_HEADER.unpack_from(string)
+		if tag != EXTENT_FORMAT:
+			raise ValueError('Unknown extent format {0}'.format(tag))
+		chunks = [EXTENT_CHUNK.unpack_from(string, EXTENT_HEADER.size + i * EXTENT_CHUNK.size)
+				  for i in range(count)]
+		return Extent(chunks, length, bool(flags & EXTENT_COMPRESSED))
+
+	def store(self, storage):
+		if self._referent is not None and not self._address:
+			data = memoryview(self.referent_to_string(self._referent))
+			size = self._chunk_size
+			self._address = storage.write(self._write_chunks(
+				storage,
+				(data[i:i + size] for i in range(0, len(data), size)),
+				self._compress))
+
+	def get(self, storage, cache=None):
+		# Large values are never pinned to the ref; each get streams them.
+		if self._referent is None and self._address:
+			return self.string_to_referent(self.open(storage).read())
+		return self._referent
+
+	def open(self, storage):
+		if self._referent is not None or not self._address:
+			return super().open(storage)
+		return io.BufferedReader(
+			ExtentReader(storage, self._decode(storage.read(self._address))))
+
+	def copy_to(self, storage, destination):
+		if not self._address:
+			return 0
+		extent = self._decode(storage.read(self._address))
+		extent.chunks = [(destination.write(storage.read(address)), length)
+						 for address, length in extent.chunks]
+		return destination.write(self._encode(extent))
+
+class ExtentReader(io.RawIOBase):
+
+	def __init__(self, storage, extent):
+		self._storage = storage
+		self._extent = extent
+		self._next_chunk = 0
+		self._pending = memoryview(b'')
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		while not self._pending:
+			if self._next_chunk == len(self._extent.chunks):
+				return 0
+			address, _ = self._extent.chunks[self._next_chunk]
+			self._next_chunk += 1
+			data = self._storage.read(address)
+			if self._extent.compressed:
+				data = zlib.decompress(data)
+			self._pending = memoryview(data)
+		count = min(len(buffer), len(self._pending))
+		buffer[:count] = self._pending[:count]
+		self._pending = self._pending[count:]
+		return count
+
+VALUE_REF_CLASSES = {
+	ValueRef.KIND: ValueRef,
+	ExtentValueRef.KIND: ExtentValueRef,
+}
+
 class LogicalBase(object):
 
+	node_ref_class = None
+	value_ref_class = ValueRef
+
+	def __init__(self, storage, node_cache=None, large_value_threshold=None,
+			chunk_size=ExtentValueRef.DEFAULT_CHUNK_SIZE, compress_values=False):
+		self._storage = storage
+		self._node_cache = node_cache
+		self._large_value_threshold = large_value_threshold
+		self._chunk_size = chunk_size
+		self._compress_values = compress_values
+		self._generation = storage.generation
+		self._refresh_tree_ref()
+
 	def set(self, key, value):
 		if self._storage.lock():
 			self._refresh_tree_ref()
 		self._tree_ref = self._insert(
-			self._follow(self._tree_ref), key, self.value_ref_class(value))
+			self._follow(self._tree_ref), key, self._value_ref(value))
+
+	def set_stream(self, key, stream):
+		if self._storage.lock():
+			self._refresh_tree_ref()
+		value_ref = ExtentValueRef.from_stream(
+			self._storage, stream, self._chunk_size, self._compress_values)
+		self._tree_ref = self._insert(
+			self._follow(self._tree_ref), key, value_ref)
+
+	def _value_ref(self, value):
+		if (self._large_value_threshold is not None
+				and len(value) > self._large_value_threshold):
+			return ExtentValueRef(
+				value, chunk_size=self._chunk_size, compress=self._compress_values)
+		return self.value_ref_class(value)
 
 	def get(self, key):
 		if not self._storage.locked:
 			self._refresh_tree_ref()
-		return self._get(self._follow(self._tree_ref), key)
+		return self._follow(self._get(self._follow(self._tree_ref), key))
+
+	def open_value(self, key):
+		if not self._storage.locked:
+			self._refresh_tree_ref()
+		return self._get(self._follow(self._tree_ref), key).open(self._storage)
+
+	def pop(self, key):
+		if self._storage.lock():
+			self._refresh_tree_ref()
+		self._tree_ref = self._delete(self._follow(self._tree_ref), key)
+
+	def keys(self, start=None, stop=None, reverse=False):
+		return (key for key, _ in self._scan(start, stop, reverse))
+
+	def items(self, start=None, stop=None, reverse=False):
+		return ((key, self._follow(value_ref))
+				for key, value_ref in self._scan(start, stop, reverse))
+
+	def prefix(self, prefix):
+		for key, value_ref in self._scan(prefix, None, False):
+			if not key.startswith(prefix):
+				break
+			yield key, self._follow(value_ref)
+
+	def _scan(self, start, stop, reverse):
+		# Pin the root now, not on first next(), so the whole scan sees one
+		# version of the tree whatever is set or committed meanwhile.
+		if not self._storage.locked:
+			self._refresh_tree_ref()
+		return self._iter(self._follow(self._tree_ref), start, stop, reverse)
+
+	def bulk_load(self, items):
+		acquired = self._storage.lock()
+		if acquired:
+			self._refresh_tree_ref()
+		try:
+			root_address = self._build(self._stored_values(items))
+		except BaseException:
+			# Nothing was committed, so drop the lock this call took and
+			# pick up whatever other handles committed meanwhile; otherwise
+			# our next commit would write an old root over theirs.
+			if acquired:
+				self._storage.unlock()
+				self._refresh_tree_ref()
+			raise
+		self._tree_ref = self.node_ref_class(address = root_address)
+		self._storage.commit_root_address(root_address)
+		return len(self)
+
+	def _stored_values(self, items):
+		first, previous = True, None
+		for key, value in items:
+			if not first and not previous < key:
+				raise ValueError('Bulk load keys must be strictly increasing.')
+			value_ref = self._value_ref(value)
+			value_ref.store(self._storage)
+			first, previous = False, key
+			yield key, value_ref
+
+	def set_many(self, items):
+		if self._storage.lock():
+			self._refresh_tree_ref()
+		batch = {}
+		for key, value in items:
+			batch[key] = value
+		keys = sorted(batch)
+		self._tree_ref = self._insert_many(
+			self._tree_ref, keys, [self._value_ref(batch[key]) for key in keys])
+
+	def pop_many(self, keys):
+		if self._storage.lock():
+			self._refresh_tree_ref()
+		self._tree_ref, removed = self._delete_many(self._tree_ref, sorted(set(keys)))
+		return removed
 
 	def _refresh_tree_ref(self):
-		self._tree_ref = self.node_ref_class(
-			address = self._storage.get_root_address())
+		root_address = self._storage.get_root_address()
+		if self._storage.generation != self._generation:
+			if self._node_cache is not None:
+				self._node_cache.clear()
+			self._generation = self._storage.generation
+		self._tree_ref = self.node_ref_class(address = root_address)
+
+	def _follow(self, ref):
+		if isinstance(ref, self.node_ref_class):
+			if self._storage.stats is not None:
+				self._storage.stats.nodes_followed += 1
+			return ref.get(self._storage, self._node_cache)
+		return ref.get(self._storage)
 
 	def commit(self):
+		# Writes take the lock and refresh the root first, so without it
+		# there is nothing to commit, and our root may be older than one
+		# another process has committed since.
+		if not self._storage.locked:
+			return
 		self._tree_ref.store(self._storage)
 		self._storage.commit_root_address(self._tree_ref.address)
 
+	def __len__(self):
+		if not self._storage.locked:
+			self._refresh_tree_ref()
+		root = self._follow(self._tree_ref)
+		if root:
+			return root.length
+		else:
+			return 0
@@ -0,0 +1,145 @@
+import heapq
+import operator
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import dbdb
+from dbdb import encoding
+
+# Three digits, so at most MAX_SHARDS files; the pattern must match every
+# name SHARD_NAME can produce or a reopen would miscount the shards.
+SHARD_NAME = 'shard-{0:03d}.db'
+MAX_SHARDS = 1000
+SHARD_PATTERN = re.compile(r'^shard-(\d{3})\.db$')
+
+def shard_index(key, shards):
+	# crc32 of the stored key bytes, so every process and every Python
+	# version routes a key to the same file, unlike hash().
+	return zlib.crc32(encoding.encode_key(key)[1]) % shards
+
+class ShardedDBDB(object):
+	'''
+	A directory of independent DBDB files with keys spread across them by
+	hash. Each shard has its own file lock, so writers touching different
+	shards do not queue behind each other, and a commit flushes the shards
+	written since the last one in parallel. Iteration merges the shards'
+	sorted streams, so keys still come back in order.
+
+	Commits are atomic per shard, not across shards.
+	'''
+
+	DEFAULT_SHARDS = 8
+
+	def __init__(self, path, shards=None, **options):
+		if shards is not None and not 1 <= shards <= MAX_SHARDS:
+			raise ValueError('shards must be between 1 and {0}, not {1}'.format(
+				MAX_SHARDS, shards))
+		existing = self._existing_shards(path)
+		if existing:
+			if shards is not None and shards != existing:
+				raise ValueError('{0} has {1} shards, not {2}'.format(
+					path, existing, shards))
+			shards = existing
+		else:
+			shards = shards or self.DEFAULT_SHARDS
+			os.makedirs(path, exist_ok=True)
+		self.path = path
+		self._shards = [
+			dbdb.connect(os.path.join(path, SHARD_NAME.format(i)), **options)
+			for i in range(shards)]
+		self._dirty = set()
+		self._executor = ThreadPoolExecutor(max_workers=shards)
+
+	@staticmethod
+	def _existing_shards(path):
+		if not os.path.isdir(path):
+			return 0
+		indexes = sorted(
+			int(match.group(1)) for match in map(SHARD_PATTERN.match, os.listdir(path))
+			if match)
+		if indexes != list(range(len(indexes))):
+			raise ValueError('{0} is missing shard files'.format(path))
+		return len(indexes)
+
+	@property
+	def shards(self):
+		return len(self._shards)
+
+	def _shard_for(self, key):
+		return shard_index(key, len(self._shards))
+
+	def __getitem__(self, key):
+		return self._shards[self._shard_for(key)][key]
+
+	def __setitem__(self, key, value):
+		i = self._shard_for(key)
+		self._shards[i][key] = value
+		self._dirty.add(i)
+
+	def __delitem__(self, key):
+		i = self._shard_for(key)
+		del self._shards[i][key]
+		self._dirty.add(i)
+
+	def __contains__(self, key):
+		return key in self._shards[self._shard_for(key)]
+
+	def __len__(self):
+		return sum(len(shard) for shard in self._shards)
+
+	def __iter__(self):
+		return self.keys()
+
+	def keys(self, start=None, stop=None, reverse=False):
+		return (key for key, _ in self.items(start, stop, reverse))
+
+	def items(self, start=None, stop=None, reverse=False):
+		return heapq.merge(
+			*[shard.items(start, stop, reverse) for shard in self._shards],
+			key=operator.itemgetter(0), reverse=reverse)
+
+	def prefix(self, prefix):
+		return heapq.merge(
+			*[shard.prefix(prefix) for shard in self._shards],
+			key=operator.itemgetter(0))
+
+	def commit(self):
+		dirty, self._dirty = sorted(self._dirty), set()
+		self._parallel(lambda i: self._shards[i].commit(), dirty)
+
+	def update(self, items):
+		if hasattr(items, 'keys'):
+			mapping = items
+			items = ((key, mapping[key]) for key in mapping.keys())
+		batches = {}
+		for key, value in items:
+			batches.setdefault(self._shard_for(key), []).append((key, value))
+		self._parallel(
+			lambda i: self._shards[i].update(batches[i]), sorted(batches))
+		self._dirty.difference_update(batches)
+
+	def delete_many(self, keys):
+		batches = {}
+		for key in keys:
+			batches.setdefault(self._shard_for(key), []).append(key)
+		removed = sum(self._parallel(
+			lambda i: self._shards[i].delete_many(batches[i]), sorted(batches)))
+		self._dirty.difference_update(batches)
+		return removed
+
+	def compact(self):
+		if self._dirty:
+			raise ValueError('Commit pending changes before compacting.')
+		return sum(self._parallel(
+			lambda i: self._shards[i].compact(), range(len(self._shards))))
+
+	def _parallel(self, work, indexes):
+		# Each shard is only ever touched by one of these threads at a time.
+		return list(self._executor.map(work, indexes))
+
+	def close(self):
+		self._executor.shutdown(wait=True)
+		for shard in self._shards:
+			shard.close()
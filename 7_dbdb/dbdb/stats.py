@@ -0,0 +1,35 @@
+class Stats(object):
+	'''
+	I/O counters for one database handle. Storage and the tree only touch
+	them when a Stats instance is attached, so they cost a None check when
+	disabled.
+	'''
+
+	FIELDS = (
+		'nodes_followed',
+		'reads',
+		'bytes_read',
+		'writes',
+		'bytes_written',
+		'seeks',
+		'deserializations',
+		'deserialize_seconds',
+		'lock_acquisitions',
+		'lock_wait_seconds',
+		'commits',
+		'commit_flush_seconds',
+	)
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		for field in self.FIELDS:
+			setattr(self, field, 0)
+
+	def as_dict(self):
+		return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+	def since(self, before):
+		return dict((field, getattr(self, field) - before[field])
+					for field in self.FIELDS)
@@ -1,17 +1,252 @@
+import os
+import struct
+import time
+
+import portalocker
+
+try:
+	import mmap
+except ImportError:
+	mmap = None
+
 class Storage(object):
 
+	SUPERBLOCK_SIZE = 4096
+	INTEGER_FORMAT = '!Q'
+	INTEGER_LENGTH = 8
+	SUPERSEDED_ADDRESS = INTEGER_LENGTH
+
+	def __init__(self, f, use_mmap=False):
+		self._f = f
+		self.path = os.path.abspath(f.name) if isinstance(f.name, str) else None
+		self.generation = 0
+		self.locked = False
+		self.use_mmap = use_mmap and mmap is not None
+		self.stats = None
+		self._view = None
+		self._ensure_superblock()
+
+	def _ensure_superblock(self):
+		self.lock()
+		self._seek_end()
+		end_address = self._f.tell()
+		if end_address < self.SUPERBLOCK_SIZE:
+			self._f.write(b'\x00' * (self.SUPERBLOCK_SIZE - end_address))
+		self.unlock()
+
 	def lock(self):
 		if not self.locked:
-			portalocker.lock(self._f, portalocker.LOCK_EX)
+			self._acquire()
+			while self._superseded():
+				portalocker.unlock(self._f)
+				self._reopen()
+				self._acquire()
 			self.locked = True
 			return True
 		else:
 			return False
 
+	def _acquire(self):
+		if self.stats is None:
+			portalocker.lock(self._f, portalocker.LOCK_EX)
+			return
+		started = time.perf_counter()
+		portalocker.lock(self._f, portalocker.LOCK_EX)
+		self.stats.lock_acquisitions += 1
+		self.stats.lock_wait_seconds += time.perf_counter() - started
+
+	def unlock(self):
+		if self.locked:
+			self._f.flush()
+			portalocker.unlock(self._f)
+			self.locked = False
+
+	def _seek_end(self):
+		if self.stats is not None:
+			self.stats.seeks += 1
+		self._f.seek(0, os.SEEK_END)
+
+	def _seek_superblock(self):
+		if self.stats is not None:
+			self.stats.seeks += 1
+		self._f.seek(0)
+
+	def _bytes_to_integer(self, integer_bytes):
+		return struct.unpack(self.INTEGER_FORMAT, integer_bytes)[0]
+
+	def _integer_to_bytes(self, integer):
+		return struct.pack(self.INTEGER_FORMAT, integer)
+
+	def _read_integer(self):
+		return self._bytes_to_integer(self._f.read(self.INTEGER_LENGTH))
+
+	def _write_integer(self, integer):
+		self.lock()
+		self._f.write(self._integer_to_bytes(integer))
+
+	def write(self, data):
+		self.lock()
+		self._seek_end()
+		object_address = self._f.tell()
+		self._write_integer(len(data))
+		self._f.write(data)
+		if self.stats is not None:
+			self.stats.writes += 1
+			self.stats.bytes_written += self.INTEGER_LENGTH + len(data)
+		return object_address
+
+	def read(self, address):
+		if self.use_mmap:
+			view = self._mapped(address + self.INTEGER_LENGTH)
+			if view is not None:
+				start = address + self.INTEGER_LENGTH
+				end = start + self._bytes_to_integer(view[address:start])
+				if end > len(view):
+					view = self._mapped(end)
+				data = view[start:end]
+				if self.stats is not None:
+					self._count_read(data)
+				return data
+		data = self._read_file(address)
+		if self.stats is not None:
+			self._count_read(data)
+		return data
+
+	def _read_file(self, address):
+		if self.stats is not None:
+			self.stats.seeks += 1
+		self._f.seek(address)
+		length = self._read_integer()
+		data = self._f.read(length)
+		return data
+
+	def _count_read(self, data):
+		self.stats.reads += 1
+		self.stats.bytes_read += self.INTEGER_LENGTH + len(data)
+
+	def _mapped(self, end):
+		# Slices already handed out keep the old mapping alive, so growing
+		# the map is just a matter of mapping the file again.
+		if self._view is None or len(self._view) < end:
+			self._f.flush()
+			try:
+				self._view = memoryview(
+					mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ))
+			except (ValueError, OSError):
+				self.use_mmap = False
+				self._view = None
+		return self._view
+
 	def commit_root_address(self, root_address):
 		self.lock()
+		started = time.perf_counter() if self.stats is not None else None
 		self._f.flush()
 		self._seek_superblock()
 		self._write_integer(root_address)
 		self._f.flush()
-		self.unlock()
\ No newline at end of file
+		if started is not None:
+			self.stats.commits += 1
+			self.stats.commit_flush_seconds += time.perf_counter() - started
+		self.unlock()
+
+	def get_root_address(self):
+		while not self.locked and self._superseded():
+			self._reopen()
+		return self._read_superblock_integer(0)
+
+	def _superseded(self):
+		return self._read_superblock_integer(self.SUPERSEDED_ADDRESS) != 0
+
+	def _read_superblock_integer(self, address):
+		# Other handles rewrite the superblock in place, so it must not be
+		# served from this file object's read buffer.
+		self._f.flush()
+		integer_bytes = os.pread(self._f.fileno(), self.INTEGER_LENGTH, address)
+		if self.stats is not None:
+			self.stats.reads += 1
+			self.stats.bytes_read += len(integer_bytes)
+		if len(integer_bytes) < self.INTEGER_LENGTH:
+			return 0
+		return self._bytes_to_integer(integer_bytes)
+
+	def _reopen(self):
+		# A compaction has swapped a new file in at our path; everything we
+		# know about addresses in the old file is now meaningless.
+		self._f.close()
+		self._f = open(self.path, 'r+b')
+		self._view = None
+		self.generation += 1
+
+	def swap_in(self, path):
+		self.lock()
+		os.replace(path, self.path)
+		self._f.seek(self.SUPERSEDED_ADDRESS)
+		self._write_integer(1)
+		self.unlock()
+		self._reopen()
+
+	def snapshot(self):
+		root_address = self.get_root_address()
+		self._f.flush()
+		return SnapshotStorage(
+			os.fdopen(os.dup(self._f.fileno()), 'rb'), root_address, self.use_mmap)
+
+	def sync(self):
+		self._f.flush()
+		os.fsync(self._f.fileno())
+
+	def size(self):
+		self._seek_end()
+		return self._f.tell()
+
+	def close(self):
+		self.unlock()
+		self._view = None
+		self._f.close()
+
+	@property
+	def closed(self):
+		return self._f.closed
+
+
+class SnapshotStorage(Storage):
+	'''
+	Read-only view of a database file as of one root address. It never
+	takes the file lock and reads without moving a shared file position, so
+	one instance can serve many threads.
+	'''
+
+	def __init__(self, f, root_address, use_mmap=False):
+		self._root_address = root_address
+		super().__init__(f, use_mmap=use_mmap)
+
+	@classmethod
+	def open(cls, path, use_mmap=False):
+		while True:
+			storage = cls(open(path, 'rb'), 0, use_mmap)
+			if not storage._superseded():
+				break
+			storage.close()
+		storage._root_address = storage._read_superblock_integer(0)
+		return storage
+
+	def _ensure_superblock(self):
+		pass
+
+	def lock(self):
+		raise ValueError('Snapshots are read-only.')
+
+	def unlock(self):
+		pass
+
+	def get_root_address(self):
+		return self._root_address
+
+	def stale(self):
+		return (self._superseded()
+				or self._read_superblock_integer(0) != self._root_address)
+
+	def _read_file(self, address):
+		fd = self._f.fileno()
+		length = self._bytes_to_integer(os.pread(fd, self.INTEGER_LENGTH, address))
+		return os.pread(fd, length, address + self.INTEGER_LENGTH)
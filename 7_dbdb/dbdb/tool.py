@@ -1,17 +1,61 @@
-verb_set = set(['get', 'set', 'delete'])
+import json
+import shutil
+import sys
+
+import dbdb
+
+OK = 0
+BAD_ARGS = 1
+BAD_VERB = 2
+BAD_KEY = 3
+
+verb_set = set(['get', 'set', 'delete', 'compact', 'bulk_load', 'batch', 'dump', 'load'])
+
+DEFAULT_COMMIT_EVERY = 1000
+
+def usage():
+	print('Usage:', file=sys.stderr)
+	print('\tpython -m dbdb.tool DBNAME get KEY', file=sys.stderr)
+	print('\tpython -m dbdb.tool DBNAME set KEY VALUE|-', file=sys.stderr)
+	print('\t\t(- streams the value from stdin)', file=sys.stderr)
+	print('\tpython -m dbdb.tool DBNAME delete KEY', file=sys.stderr)
+	print('\tpython -m dbdb.tool DBNAME compact', file=sys.stderr)
+	print('\tpython -m dbdb.tool DBNAME bulk_load FILE|-', file=sys.stderr)
+	print('\t\t(sorted KEY<TAB>VALUE lines; replaces the database)', file=sys.stderr)
+	print('\tpython -m dbdb.tool DBNAME batch [N]', file=sys.stderr)
+	print('\t\t(commands on stdin, one result line each; commits every N writes)', file=sys.stderr)
+	print('\tpython -m dbdb.tool DBNAME dump [FILE|-]', file=sys.stderr)
+	print('\tpython -m dbdb.tool DBNAME load FILE|- [N]', file=sys.stderr)
+	print('\t\t(KEY<TAB>VALUE or JSON lines; commits every N keys)', file=sys.stderr)
 
 def main(argv):
-	if not (4 <= len(argv) <= 5):
+	if not (3 <= len(argv) <= 5):
 		usage()
 		return BAD_ARGS
-	dbname, verb, key, value = (argv[1:] + [None])[:4]
+	dbname, verb, key, value = (argv[1:] + [None, None])[:4]
 	if verb not in verb_set:
 		usage()
 		return BAD_VERB
+	if verb in ('batch', 'dump', 'load'):
+		return bulk_verb(dbname, verb, argv[3:])
+	if (verb == 'compact') != (key is None):
+		usage()
+		return BAD_ARGS
+	if verb == 'bulk_load':
+		if value is not None:
+			usage()
+			return BAD_ARGS
+		return bulk_load(dbname, key)
 	db = dbdb.connect(dbname)			# CONNECT
 	try:
-		if verb == 'get':
-			sys.stdout.write(db[key])	# GET VALUE
+		if verb == 'compact':
+			print('Reclaimed {0} bytes'.format(db.compact()))
+		elif verb == 'get':
+			sys.stdout.flush()
+			shutil.copyfileobj(db.open_value(key), sys.stdout.buffer)	# GET VALUE
+		elif verb == 'set' and value == '-':
+			db.set_stream(key, sys.stdin.buffer)
+			db.commit()
 		elif verb == 'set':
 			db[key] = value
 			db.commit()
@@ -21,4 +65,201 @@ def main(argv):
 	except KeyError:
 		print("Key not found", file=sys.stderr)
 		return BAD_KEY
-	return OK
\ No newline at end of file
+	return OK
+
+def bulk_load(dbname, path):
+	lines = sys.stdin if path == '-' else open(path)
+	try:
+		items = (parse_item(line) for line in lines)
+		try:
+			count = dbdb.bulk_load(dbname, items)
+		except ValueError as e:
+			print(e, file=sys.stderr)
+			return BAD_ARGS
+	finally:
+		if lines is not sys.stdin:
+			lines.close()
+	print('Loaded {0} keys'.format(count))
+	return OK
+
+def bulk_verb(dbname, verb, args):
+	if verb == 'dump':
+		if len(args) > 1:
+			usage()
+			return BAD_ARGS
+		path = args[0] if args else '-'
+	elif verb == 'load':
+		if not args:
+			usage()
+			return BAD_ARGS
+		path, args = args[0], args[1:]
+	try:
+		commit_every = int(args[0]) if args and verb != 'dump' else DEFAULT_COMMIT_EVERY
+	except ValueError:
+		commit_every = 0
+	if commit_every < 1:
+		usage()
+		return BAD_ARGS
+	db = dbdb.connect(dbname)
+	try:
+		if verb == 'batch':
+			return batch(db, sys.stdin, sys.stdout, commit_every)
+		elif verb == 'dump':
+			out = sys.stdout if path == '-' else open(path, 'w')
+			try:
+				count = dump(db, out)
+			finally:
+				if out is not sys.stdout:
+					out.close()
+			print('Dumped {0} keys'.format(count), file=sys.stderr)
+		else:
+			lines = sys.stdin if path == '-' else open(path)
+			try:
+				count = load(db, lines, commit_every)
+			except ValueError as e:
+				print(e, file=sys.stderr)
+				return BAD_ARGS
+			finally:
+				if lines is not sys.stdin:
+					lines.close()
+			print('Loaded {0} keys'.format(count))
+	finally:
+		db.close()
+	return OK
+
+def parse_item(line):
+	'''
+	Parse a KEY<TAB>VALUE line, or a {"key": ..., "value": ...} JSON line
+	for keys and values the tab format cannot hold.
+	'''
+	line = line.rstrip('\n')
+	if line.startswith('{'):
+		try:
+			record = json.loads(line)
+		except ValueError:
+			pass
+		else:
+			if not isinstance(record, dict) or not {'key', 'value'} <= set(record):
+				raise ValueError('Expected a key and a value in {0!r}'.format(line))
+			check_strings(line, record['key'], record['value'])
+			return record['key'], record['value']
+	item = line.split('\t', 1)
+	if len(item) != 2:
+		raise ValueError('Expected KEY<TAB>VALUE, got {0!r}'.format(line))
+	return item
+
+def check_strings(line, *fields):
+	# JSON can carry numbers, lists and null, which would only fail once
+	# they are encoded at commit time, taking the rest of the batch along.
+	for field in fields:
+		if field is not None and not isinstance(field, str):
+			raise ValueError('Keys and values must be strings in {0!r}'.format(line))
+
+def needs_json(text):
+	# Input is read with universal newlines, so a \r splits a line too.
+	return '\n' in text or '\r' in text
+
+def format_item(key, value):
+	if key.startswith('{') or '\t' in key or needs_json(key) or needs_json(value):
+		return json.dumps({'key': key, 'value': value}) + '\n'
+	return '{0}\t{1}\n'.format(key, value)
+
+def dump(db, out):
+	count = 0
+	for key, value in db.items():
+		out.write(format_item(key, value))
+		count += 1
+	return count
+
+def load(db, lines, commit_every):
+	# Unlike bulk_load this merges into the existing tree, so the input
+	# needs no ordering; each chunk of commit_every keys is one commit.
+	count = 0
+	items = []
+	for line in lines:
+		items.append(parse_item(line))
+		if len(items) == commit_every:
+			db.update(items)
+			count += len(items)
+			items = []
+	if items:
+		db.update(items)
+		count += len(items)
+	return count
+
+def batch(db, lines, out, commit_every):
+	'''
+	Run one command per input line and write one result line per command.
+	Plain lines are get<TAB>KEY, set<TAB>KEY<TAB>VALUE, delete<TAB>KEY or
+	commit, answered with OK[<TAB>VALUE] or ERROR<TAB>MESSAGE. Lines
+	starting with { are JSON commands such as {"op": "set", "key": ...,
+	"value": ...}, answered with a JSON object. Writes are committed every
+	commit_every writes and at end of input. Each result is flushed as soon
+	as it is written, so a co-process can wait for the answer to a get.
+	A plain get whose value contains a line break is answered with a JSON
+	line instead, so every command still gets exactly one line.
+	'''
+	status = OK
+	pending = 0
+	for line in lines:
+		line = line.rstrip('\n')
+		if not line:
+			continue
+		as_json = line.startswith('{')
+		try:
+			if as_json:
+				command = json.loads(line)
+				if not isinstance(command, dict):
+					raise ValueError('Bad command {0!r}'.format(line))
+				op, key, value = command.get('op'), command.get('key'), command.get('value')
+				check_strings(line, key, value)
+			else:
+				op, key, value = (line.split('\t', 2) + [None, None])[:3]
+			result = None
+			if op == 'get' and key is not None:
+				result = db[key]
+			elif op == 'set' and key is not None and value is not None:
+				db[key] = value
+				pending += 1
+			elif op == 'delete' and key is not None:
+				del db[key]
+				pending += 1
+			elif op == 'commit' and key is None:
+				db.commit()
+				pending = 0
+			else:
+				raise ValueError('Bad command {0!r}'.format(line))
+		except KeyError:
+			status = BAD_KEY
+			out.write(_batch_result(as_json, error='Key not found'))
+		except ValueError as e:
+			status = BAD_ARGS
+			out.write(_batch_result(as_json, error=str(e)))
+		else:
+			out.write(_batch_result(as_json, value=result))
+		out.flush()
+		if pending >= commit_every:
+			db.commit()
+			pending = 0
+	if pending:
+		db.commit()
+	return status
+
+def _batch_result(as_json, value=None, error=None):
+	if as_json:
+		result = {'ok': error is None}
+		if error is not None:
+			result['error'] = error
+		elif value is not None:
+			result['value'] = value
+		return json.dumps(result) + '\n'
+	if error is not None:
+		return 'ERROR\t{0}\n'.format(error)
+	if value is not None and needs_json(value):
+		return _batch_result(True, value=value)
+	if value is not None:
+		return 'OK\t{0}\n'.format(value)
+	return 'OK\n'
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))